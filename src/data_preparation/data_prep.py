@@ -1,6 +1,8 @@
 import numpy as np
 import pandas as pd
 
+from sim.households import household_vars
+
 def SOEP_to_df_old(dataf):
     """
     This function takes the SOEP data as a dataframe and returns the the harmonized data such that the rest of the code can work with it. It also renames the columns etc
@@ -125,74 +127,21 @@ def _numeric_hours(dataf):
 # Making household wide variables
 def make_hh_vars(dataf):
     dataf = dataf.copy()
-    dataf = _get_multiindex(dataf)
-
-    dataf = _hh_income(dataf)
-    dataf = _hh_age_youngest(dataf)
-    dataf = _hh_fraction_working(dataf)
-    dataf = _indicate_birth(dataf)
-    dataf.reset_index(inplace=True, drop=True)
-    return dataf
-
-
-def _get_tupleindices(dataf):
-    years = dataf['year'].tolist()
-    hids = dataf['hid'].tolist()
-    return list(zip(years, hids))
-
-def _get_multiindex(dataf):
-    dataf = dataf.copy()
-    index_list = _get_tupleindices(dataf)
-
-    mindex = pd.MultiIndex.from_tuples(index_list, names=['year' ,
-                                                          'hid'])
-    dataf_out = dataf.set_index(mindex)
-    dataf_out = dataf_out.sort_index(level=1)
-
-    return dataf_out
-
-def _hh_income(dataf):
-    dataf = dataf.copy()
-    earnings = dataf.groupby(level=['year', 'hid'])['gross_earnings'].sum()
-    dataf['hh_income'] = earnings
-    return dataf
-
-def _hh_size(dataf):
-    dataf = dataf.copy()
-    size = dataf.groupby(level=['year', 'hid'])['gross_earnings'].size()
-    dataf['n_people'] = size
-    return dataf
-
-def _hh_children(dataf):
-    dataf = dataf.copy()
-    children = dataf.groupby(level=['year', 'hid'])['child'].sum()
-    dataf['n_children'] = children
-    return dataf
-
-def _hh_fraction_working(dataf):
-    dataf = dataf.copy()
-
-    dataf = _hh_size(dataf)
-    dataf = _hh_children(dataf)
 
-    total = dataf.groupby(level=['year', 'hid'])['working'].sum()
-    dataf['total_working'] = total
+    hh_vars = household_vars(dataf['hid'],
+                             dataf['age'],
+                             dataf['child'],
+                             dataf['gross_earnings'],
+                             dataf['working'],
+                             year=dataf['year'])
+    for var, values in hh_vars.items():
+        dataf[var] = values
 
-    dataf['n_adults'] = dataf['n_people'] - dataf['n_children']
-    dataf['hh_frac_working'] = dataf['total_working']/dataf['n_adults']
-    dataf.loc[dataf['n_adults']==0, 'hh_frac_working'] = 0
+    # Households without adults are counted as not working
+    dataf.loc[dataf['n_people']==dataf['n_children'], 'hh_frac_working'] = 0
 
-    # Children could also be working, but bound it at 1
-    dataf.loc[dataf["hh_frac_working"]>1, "hh_frac_working"] = 1
-
-    dataf.drop(['total_working', 'n_adults'], axis=1, inplace=True)
-    return dataf
-
-def _hh_age_youngest(dataf):
-    dataf = dataf.copy()
-
-    smallest_age = dataf.groupby(level=['year', 'hid'])['age'].min()
-    dataf['hh_youngest_age'] = smallest_age
+    dataf = _indicate_birth(dataf)
+    dataf.reset_index(inplace=True, drop=True)
     return dataf
 
 def _indicate_birth(dataf):
@@ -202,10 +151,7 @@ def _indicate_birth(dataf):
 
     dataf = dataf.copy()
 
-    minage = dataf.groupby(level=['year', 'hid'])['age'].min()
-    dataf["minage"] = minage
     dataf["birth"] = 0
-    dataf.loc[(dataf["minage"]==0)&(dataf["female"]==1)&(dataf["child"]==0), "birth"] = 1
-    dataf.drop("minage", axis=1, inplace=True)
+    dataf.loc[(dataf["hh_youngest_age"]==0)&(dataf["female"]==1)&(dataf["child"]==0), "birth"] = 1
 
     return dataf
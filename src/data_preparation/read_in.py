@@ -18,9 +18,11 @@ dir = "/Users/christianhilscher/Desktop/dynsim"
 input_path = dir + "/input/"
 working_dir = dir + "/src/data_preparation"
 
+# Run from src as python -m data_preparation.read_in, like the sim and
+# estimation scripts, so the sim package can be imported
 os.chdir(working_dir)
-from cleaning import SOEP_to_df
-from data_prep import SOEP_to_df_old
+from data_preparation.cleaning import SOEP_to_df
+from data_preparation.data_prep import SOEP_to_df_old
 
 
 def make_hh_vars(dataf):
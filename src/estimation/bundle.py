@@ -0,0 +1,104 @@
+from pathlib import Path
+from datetime import datetime
+import json
+import shutil
+import numpy as np
+import pandas as pd
+
+from estimation.extended import data_general
+from estimation.transition_matrices.get_matrices import conditional_tensor
+from estimation.model_table import standard_models, extended_models
+
+###############################################################################
+dir = Path(__file__).parents[2]
+estimation_path = dir / "src/estimation"
+model_path = dir / "src/estimation/models"
+###############################################################################
+
+# Format version of the bundles written here, checked by sim.registry on load
+bundle_version = 1
+
+
+def _scaler_arrays(scaler):
+    return {'mean': scaler.mean_,
+            'scale': scaler.scale_,
+            'var': scaler.var_}
+
+def _linear_arrays(model):
+    arrays = {'coef': model.coef_,
+              'intercept': np.asarray(model.intercept_)}
+    if hasattr(model, 'classes_'):
+        arrays['classes'] = model.classes_
+    return arrays
+
+def _features(X):
+    return {'names': X.columns.tolist(),
+            'dtypes': [str(dtype) for dtype in X.dtypes]}
+
+class _BundleWriter:
+
+    def __init__(self, bundle_path):
+        self.path = Path(bundle_path)
+        self.entries = []
+        (self.path / "arrays").mkdir(parents=True, exist_ok=True)
+        (self.path / "boosters").mkdir(parents=True, exist_ok=True)
+
+    def add_arrays(self, kind, variable, arrays):
+        files = {}
+        for name, array in arrays.items():
+            file = str("arrays/" + kind + "_" + variable + "_" + name + ".npy")
+            np.save(self.path / file, np.asarray(array))
+            files[name] = file
+        self.entries.append({'kind': kind, 'variable': variable, 'arrays': files})
+
+    def add_booster(self, kind, variable, model_file):
+        file = str("boosters/" + kind + "_" + variable + ".txt")
+        shutil.copyfile(model_file, self.path / file)
+        self.entries.append({'kind': kind, 'variable': variable, 'model': file})
+
+def write_bundle(dataf, bundle_path, model_path=model_path, estimation_path=estimation_path):
+    """
+    Collects the artifacts of one estimation run into one directory.
+
+    Scaler and linear model parameters are stored as .npy arrays which the
+    sim memory maps, LightGBM models in LightGBM's own model format. The
+    manifest lists every artifact together with the feature names and dtypes
+    the models expect, taken from the data_* functions on dataf, the lag panel
+    the models were estimated on.
+    """
+    model_path = Path(model_path)
+    writer = _BundleWriter(bundle_path)
+    features = {}
+
+    for variable, (data_function, _, kind) in standard_models.items():
+        features[str("standard/" + variable)] = _features(data_function(dataf, estimate=0))
+
+        writer.add_arrays(kind, variable,
+                          _linear_arrays(pd.read_pickle(model_path / str(variable + "_" + kind))))
+        writer.add_arrays('X_scaler', variable,
+                          _scaler_arrays(pd.read_pickle(model_path / str(variable + "_X_scaler"))))
+        if kind == 'ols':
+            writer.add_arrays('y_scaler', variable,
+                              _scaler_arrays(pd.read_pickle(model_path / str(variable + "_y_scaler"))))
+        writer.add_booster('ml', variable, model_path / str(variable + "_ml.txt"))
+
+    for variable in extended_models:
+        features[str("extended/" + variable)] = _features(data_general(dataf, variable, estimate=0))
+
+        writer.add_arrays('X_scaler_multi', variable,
+                          _scaler_arrays(pd.read_pickle(model_path / variable / "_X_scaler_multi")))
+        writer.add_booster('extended', variable, model_path / variable / "_extended.txt")
+
+    transition_matrices = pd.read_pickle(Path(estimation_path) / "transition_matrices/full_sample")
+    writer.add_arrays('transition_tensor', 'full_sample',
+                      {'tensor': conditional_tensor(transition_matrices)})
+
+    manifest = {'format': 'dynasim-model-bundle',
+                'version': bundle_version,
+                'created': datetime.now().isoformat(timespec='seconds'),
+                'artifacts': writer.entries,
+                'features': features}
+    with open(writer.path / "manifest.json", "w") as file:
+        json.dump(manifest, file, indent=2)
+
+    return manifest
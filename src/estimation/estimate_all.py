@@ -0,0 +1,89 @@
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+import os
+import time
+import pandas as pd
+
+from threadpoolctl import threadpool_limits
+
+from estimation.standard import getdf
+from estimation.extended import _estimate
+from estimation.bundle import write_bundle
+from estimation.model_table import standard_models, extended_models
+
+###############################################################################
+dir = Path(__file__).parents[2]
+input_path = dir / "input"
+bundle_path = dir / "src/estimation/models_bundle"
+###############################################################################
+
+# Lag panel of the worker process, set once when the worker starts
+_panel = None
+
+
+def _share_panel(dataf):
+    global _panel
+    _panel = dataf
+
+def _estimate_model(approach, variable, num_threads):
+    """
+    Estimates one model on the shared panel and returns the seconds it took
+    """
+    start = time.time()
+
+    # Also bounds the BLAS threads of the logit and OLS fits
+    with threadpool_limits(limits=num_threads):
+        if approach == 'standard':
+            estimate_function = standard_models[variable][1]
+            estimate_function(_panel, num_threads=num_threads)
+        else:
+            _estimate(_panel, variable, extended_models[variable], num_threads=num_threads)
+
+    return time.time() - start
+
+def estimate_all(panel, n_jobs=None):
+    """
+    Estimates all models of the standard and the extended approach on panel,
+    the lag panel of getdf.
+
+    The panel is handed to every worker once when it starts.
+    The models are trained concurrently, every one with an equal share of the
+    cores so the LightGBM threads of the workers don't compete. The artifacts
+    are the same as running standard.py and extended.py one after the other.
+
+    Returns the seconds every model took, keyed by (approach, variable).
+    """
+    jobs = ([('extended', variable) for variable in extended_models]
+            + [('standard', variable) for variable in standard_models])
+
+    n_cores = os.cpu_count() or 1
+    if n_jobs is None:
+        n_jobs = n_cores
+    n_jobs = max(1, min(n_jobs, len(jobs)))
+    num_threads = max(1, n_cores // n_jobs)
+
+    if n_jobs > 1:
+        with ProcessPoolExecutor(max_workers=n_jobs,
+                                 initializer=_share_panel,
+                                 initargs=(panel,)) as executor:
+            futures = {job: executor.submit(_estimate_model, *job, num_threads)
+                       for job in jobs}
+            timings = {job: future.result() for job, future in futures.items()}
+    else:
+        _share_panel(panel)
+        timings = {job: _estimate_model(*job, num_threads) for job in jobs}
+
+    return timings
+
+
+###############################################################################
+if __name__ == "__main__":
+    df = pd.read_pickle(input_path / 'merged').dropna()
+
+    panel = getdf(df)
+
+    timings = estimate_all(panel)
+    for (approach, variable), seconds in timings.items():
+        print(approach, variable, round(seconds, 1))
+
+    write_bundle(panel, bundle_path)
@@ -162,7 +162,7 @@ def _prepare_regressor(dataf, dep_var):
                 open(model_path / str(dep_var + "_scaler_ext"), 'wb'))
     return out_dici
 
-def _estimate(dataf, dep_var, type):
+def _estimate(dataf, dep_var, type, num_threads=0):
     dataf = dataf.copy()
 
     dataf = data_general(dataf, dep_var)
@@ -180,6 +180,7 @@ def _estimate(dataf, dep_var, type):
                   'bagging_fraction': [0.8],
                   'bagging_freq': [5],
                   'verbose' : 5,
+                  'num_threads': num_threads,
                   'early_stopping_rounds': 5}
         pickle.dump(dict['y_scaler'],
                     open(model_path / str(dep_var + "_y_scaler_multi"), 'wb'))
@@ -194,6 +195,7 @@ def _estimate(dataf, dep_var, type):
                 'feature_fraction': [0.9],
                 'num_leaves': 31,
                 'verbose': 0,
+                'num_threads': num_threads,
                 'early_stopping_rounds': 5}
     else:
         dict = _prepare_classifier(dataf)
@@ -207,6 +209,7 @@ def _estimate(dataf, dep_var, type):
                   'feature_fraction': [0.9],
                   'num_leaves': 31,
                   'verbose': 0,
+                  'num_threads': num_threads,
                   'early_stopping_rounds': 5}
 
     modl = lgb.train(params,
@@ -1,16 +1,20 @@
 from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+import os
+import time
+import tempfile
 import numpy as np
 import pandas as pd
 import pickle
 
 import statsmodels.api as sm
+
 from sklearn.preprocessing import StandardScaler
-from sklearn.model_selection import train_test_split
+from sklearn.model_selection import GroupKFold, train_test_split
 
 import lightgbm as lgb
-from sklearn.linear_model import LogisticRegression, LinearRegression
 
-from standard import getdf, get_dependent_var
+from estimation.standard import getdf
 
 ###############################################################################
 dir = Path(__file__).resolve().parents[2]
@@ -65,6 +69,102 @@ def data_general(dataf, dep_var, estimate=1):
 
     return dataf
 
+def _dataset_file(X, y, weights, features, directory):
+    """
+    Binned dataset saved in LightGBM's binary format in directory, so the
+    folds read the bins instead of computing them again
+    """
+    dataset_file = Path(directory) / "dataset.bin"
+    dataset = lgb.Dataset(X, y,
+                          weight = weights,
+                          feature_name = features,
+                          params = {'verbose': -1})
+    dataset.save_binary(str(dataset_file))
+    return dataset_file
+
+def _train_fold(dataset_file, params, train_index, valid_index, num_threads):
+    """
+    Trains one fold on subsets of the binned dataset, so the bins are never
+    computed again
+    """
+    start = time.time()
+
+    dataset = lgb.Dataset(str(dataset_file), params = {'verbose': -1})
+    train_set = dataset.subset(train_index)
+    valid_set = dataset.subset(valid_index)
+
+    evals = {}
+    booster = lgb.train(dict(params, num_threads=num_threads),
+                        train_set = train_set,
+                        valid_sets = [valid_set],
+                        valid_names = ['valid'],
+                        callbacks = [lgb.record_evaluation(evals)])
+
+    metric, curve = list(evals['valid'].items())[0]
+    out_dici = {'model': booster.model_to_string(),
+                'metric': metric,
+                'curve': curve,
+                'best_iteration': booster.best_iteration,
+                'seconds': time.time() - start}
+    return out_dici
+
+def grouped_cv(X, y, weights, groups, params, features, dep_var, nfold=10, n_jobs=None):
+    """
+    Cross-validation with folds grouped by person.
+
+    Every pid is in exactly one validation fold. The binned dataset is built
+    once into a temporary file that is deleted afterwards, the folds are
+    trained in parallel workers and every fold stops early on its own
+    validation set. The best iteration is where the mean validation loss over
+    the folds is lowest.
+
+    Returns the curves like lgb.cv, the cvbooster and a frame with the
+    timings and metrics of every fold.
+    """
+    folds = list(GroupKFold(n_splits=nfold).split(X, y, groups))
+
+    n_cores = os.cpu_count() or 1
+    if n_jobs is None:
+        n_jobs = n_cores
+    n_jobs = max(1, min(n_jobs, nfold))
+    num_threads = max(1, n_cores // n_jobs)
+
+    with tempfile.TemporaryDirectory(prefix=str("cv_" + dep_var + "_")) as directory:
+        dataset_file = _dataset_file(X, y, weights, features, directory)
+        if n_jobs > 1:
+            with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+                futures = [executor.submit(_train_fold, dataset_file, params,
+                                           train_index, valid_index, num_threads)
+                           for train_index, valid_index in folds]
+                results = [future.result() for future in futures]
+        else:
+            results = [_train_fold(dataset_file, params, train_index, valid_index, num_threads)
+                       for train_index, valid_index in folds]
+
+    # Only the rounds every fold got to can be averaged
+    metric = results[0]['metric']
+    n_rounds = min(len(result['curve']) for result in results)
+    curves = np.array([result['curve'][:n_rounds] for result in results])
+    mean = curves.mean(axis=0)
+    best_iteration = int(np.argmin(mean)) + 1
+
+    cvbooster = lgb.CVBooster()
+    cvbooster.boosters = [lgb.Booster(model_str=result['model']) for result in results]
+    cvbooster.best_iteration = best_iteration
+
+    folds_info = pd.DataFrame({'fold': np.arange(nfold),
+                               'n_train': [len(train_index) for train_index, valid_index in folds],
+                               'n_valid': [len(valid_index) for train_index, valid_index in folds],
+                               'best_iteration': [result['best_iteration'] for result in results],
+                               metric: [np.min(result['curve']) for result in results],
+                               'seconds': [result['seconds'] for result in results]})
+
+    out_dici = {str(metric + "-mean"): list(mean[:best_iteration]),
+                str(metric + "-stdv"): list(curves.std(axis=0)[:best_iteration]),
+                'cvbooster': cvbooster,
+                'folds': folds_info}
+    return out_dici
+
 def _prepare_classifier(dataf):
     dataf = dataf.copy()
 
@@ -162,14 +262,23 @@ def _prepare_regressor(dataf, dep_var):
                 open(model_path / str(dep_var + "_scaler_ext"), 'wb'))
     return out_dici
 
-def _estimate(dataf, dep_var, type):
+def _estimate(dataf, dep_var, type, nfold=10, n_jobs=None):
     dataf = dataf.copy()
 
-    dataf = data_general(dataf, dep_var)
-    dataf.dropna(inplace=True)
+    data = data_general(dataf, dep_var)
+    data.dropna(inplace=True)
+    groups = dataf.loc[data.index, 'pid'].to_numpy()
+
+    y = data['dep_var'].to_numpy()
+    weights = data['personweight'].to_numpy()
+    X = data.drop(['dep_var', 'personweight'], axis=1)
+    if "personweight_interacted" in X.columns.tolist():
+        X.drop('personweight_interacted', axis=1, inplace=True)
+
+    features = X.columns.tolist()
+    X = StandardScaler().fit_transform(np.asarray(X))
 
     if type == 'regression':
-        dict = _prepare_regressor(dataf, dep_var)
         params = {'boosting_type' : 'gbdt',
                   'n_estimators': 350,
                   'objective' : 'l2',
@@ -181,45 +290,35 @@ def _estimate(dataf, dep_var, type):
                   'bagging_freq': [5],
                   'verbose' : 5,
                   'early_stopping_rounds': 5}
+        dict = _prepare_regressor(data, dep_var)
         pickle.dump(dict['y_scaler'],
                     open(model_path / str(dep_var + "_y_scaler_multi"), 'wb'))
     elif type == 'binary':
-            dict = _prepare_classifier(dataf)
             params = {'task' : 'train',
                 'boosting_type' : 'gbdt',
                 'n_estimators': 350,
                 'objective': 'binary',
-                'eval_metric': 'logloss',
+                'metric': 'binary_logloss',
                 'learning_rate': 0.05,
                 'feature_fraction': [0.9],
                 'num_leaves': 31,
                 'verbose': 0,
                 'early_stopping_rounds': 5}
     else:
-        dict = _prepare_classifier(dataf)
         params = {'task' : 'train',
                   'boosting_type' : 'gbdt',
                   'n_estimators': 350,
                   'objective': 'multiclass',
-                  'num_class': len(dict['y_train'].unique()),
-                  'eval_metric': 'multi_logloss',
+                  'num_class': len(np.unique(y)),
+                  'metric': 'multi_logloss',
                   'learning_rate': 0.05,
                   'feature_fraction': [0.9],
                   'num_leaves': 31,
                   'verbose': 0,
                   'early_stopping_rounds': 5}
 
-    modl = lgb.cv(params,
-                     train_set = dict['lgb_train'],
-                     nfold=10,
-                     return_cvbooster=True)
-
-    # Make directory if it doesn't exist yet
-    # Path(model_path / dep_var).mkdir(parents=True, exist_ok=True)
-    # modl.save_model(str(model_path / dep_var / "_extended.txt"))
-
-    # pickle.dump(dict['X_scaler'],
-    #             open(model_path / dep_var / "_X_scaler_multi", 'wb'))
+    modl = grouped_cv(X, y, weights, groups, params, features, dep_var,
+                      nfold=nfold, n_jobs=n_jobs)
     return modl
 
 
@@ -230,14 +329,7 @@ if __name__ == "__main__":
     df = pd.read_pickle(input_path / 'merged').dropna()
     df1 = getdf(df)
 
-    _estimate(df1, "employment_status", "multiclass")
+    cv_results = _estimate(df1, "employment_status", "multiclass")
+    print(cv_results['folds'])
     # _estimate(df1, "hours", "regression")
     # _estimate(df1, "gross_earnings", "regression")
-
-
-df = pd.read_pickle(input_path / 'merged').dropna()
-df1 = getdf(df)
-
-abc = _estimate(df1, "employment_status", "multiclass")
-
-abc["cvbooster"].boosters[1].feature_importance()
\ No newline at end of file
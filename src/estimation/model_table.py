@@ -0,0 +1,19 @@
+from estimation.standard import data_birth, data_retired, data_working, data_fulltime, data_hours, data_earnings
+from estimation.standard import estimate_birth, estimate_retired, estimate_working, estimate_fulltime, estimate_hours, estimate_earnings
+
+###############################################################################
+
+# Data function, estimate function and linear model of every variable in the
+# standard approach. Every variable also has a LightGBM model.
+standard_models = {'retired': (data_retired, estimate_retired, 'logit'),
+                   'working': (data_working, estimate_working, 'logit'),
+                   'fulltime': (data_fulltime, estimate_fulltime, 'logit'),
+                   'birth': (data_birth, estimate_birth, 'logit'),
+                   'hours': (data_hours, estimate_hours, 'ols'),
+                   'gross_earnings': (data_earnings, estimate_earnings, 'ols')}
+
+# LightGBM models of the extended approach and their type, the data of all of
+# them comes from extended.data_general
+extended_models = {'employment_status': 'multiclass',
+                   'hours': 'regression',
+                   'gross_earnings': 'regression'}
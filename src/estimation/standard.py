@@ -16,42 +16,79 @@ input_path = dir / "input"
 model_path = dir /"src/estimation/models/"
 ###############################################################################
 
+# Variables whose previous values are used, and how many years back
+lag_vars = {'retired': 1,
+            'working': 1,
+            'fulltime': 1,
+            'hours': 2,
+            'gross_earnings': 2,
+            'employment_status': 2}
+
+def make_lags(dataf, lags=lag_vars):
+    """
+    Adds the values of the previous years as _t1, _t2, ... columns.
+
+    The rows are sorted by (pid, year) once and shifted within each pid. A
+    lag is only filled if the person was observed in exactly that year,
+    otherwise it is NaN. The rows keep their original order.
+    """
+    dataf = dataf.copy()
+
+    pid = dataf['pid'].to_numpy()
+    year = dataf['year'].to_numpy()
+    order = np.lexsort((year, pid))
+    pid = pid[order]
+    year = year[order]
+    n = len(order)
+
+    same_pid = pid[1:] == pid[:-1]
+    if np.any(same_pid & (year[1:] == year[:-1])):
+        raise ValueError('pid and year do not identify the rows')
+
+    for lag in range(1, max(lags.values()) + 1):
+        # Rows are unique per (pid, year), so a difference of exactly lag
+        # years between rows lag apart means the years in between are there
+        consecutive = np.zeros(n, dtype=bool)
+        consecutive[lag:] = (pid[lag:] == pid[:-lag]) & (year[lag:] - year[:-lag] == lag)
+
+        for var, max_lag in lags.items():
+            if max_lag < lag:
+                continue
+            values = dataf[var].to_numpy(dtype=np.float64)[order]
+            shifted = np.full(n, np.nan)
+            shifted[lag:] = values[:-lag]
+            shifted[~consecutive] = np.nan
+
+            lagged = np.empty(n)
+            lagged[order] = shifted
+            dataf[var + '_t' + str(lag)] = lagged
+
+    return dataf
+
 # Getting dataframe into right shape
 def getdf(dataf):
-    dataf = dataf.copy()
+    # Only keeping those with more than two observed years
+    condition = dataf.groupby('pid')['year'].transform('count')>2
+    dataf = dataf[condition]
+
+    columns = (['pid']
+               + [col for col in dataf.columns if col != 'pid']
+               + ['hours_t1',
+                  'gross_earnings_t1',
+                  'retired_t1',
+                  'working_t1',
+                  'fulltime_t1',
+                  'hours_t2',
+                  'gross_earnings_t2',
+                  'employment_status_t1',
+                  'employment_status_t2'])
+
+    # Ordered by year like the estimation data always was
+    dataf_out = make_lags(dataf)
+    dataf_out = dataf_out.sort_values('year', kind='mergesort')[columns]
 
-    # Only keeping those with more than two consective years
-    condition = dataf.groupby('pid')['year'].count()>2
-    dataf = dataf.set_index('pid')[condition]
-    year_list = dataf['year'].unique()
-
-    # Making space
-    dataf['hours_t1'] = np.NaN
-    dataf['gross_earnings_t1'] = np.NaN
-
-    # Final dataframe for output
-    dataf_out = pd.DataFrame()
-
-    # For each year use the previous year's values to fill up t-1 and t-2 columns
-    for i in np.sort(year_list)[2:]:
-        df_now = dataf[dataf['year'] == i].copy()
-        df_yesterday = dataf[dataf['year'] == (i-1)].copy()
-        df_twoyesterdays = dataf[dataf['year'] == (i-2)].copy()
-
-        df_now['retired_t1'] = df_yesterday['retired']
-        df_now['working_t1'] = df_yesterday['working']
-        df_now['fulltime_t1'] = df_yesterday['fulltime']
-        df_now['hours_t1'] = df_yesterday['hours']
-        df_now['hours_t2'] = df_twoyesterdays['hours']
-        df_now['gross_earnings_t1'] = df_yesterday['gross_earnings']
-        df_now['gross_earnings_t2'] = df_twoyesterdays['gross_earnings']
-        df_now['employment_status_t1'] = df_yesterday['employment_status']
-        df_now['employment_status_t2'] = df_twoyesterdays['employment_status']
-
-        dataf_out = pd.concat([dataf_out, df_now])
-
-    dataf_out.reset_index(inplace=True)
     dataf_out.dropna(inplace=True)
+    dataf_out.reset_index(drop=True, inplace=True)
     return dataf_out
 
 
@@ -164,6 +201,38 @@ def _prepare_regressor(dataf):
                 'weights': weights_train}
     return out_dici
 
+def split_design(dataf):
+    """
+    Features, dependent variable and weights of a frame made by a data_* function
+    """
+    y = dataf['dep_var'].to_numpy()
+    weights = dataf['personweight'].to_numpy()
+
+    X = dataf.drop(['dep_var', 'personweight'], axis=1)
+    if "personweight_interacted" in X.columns.tolist():
+        X = X.drop('personweight_interacted', axis=1)
+    return X, y, weights
+
+def sufficient_stats(dataf, X_scaler, model, y_scaler=None):
+    """
+    Statistics of the estimation data a logit (no y_scaler) or OLS fit can be
+    updated from when new rows come in, see warm_start.py
+    """
+    X, y, weights = split_design(dataf)
+    X = np.column_stack([np.ones(len(X)), X_scaler.transform(np.asarray(X))])
+
+    if y_scaler is None:
+        # Curvature of the weighted log likelihood at the estimate
+        prob = model.predict_proba(X[:, 1:])[:, 1]
+        stats = {'hessian': X.T @ (X * (weights * prob * (1 - prob))[:, None])}
+    else:
+        y = np.ravel(y_scaler.transform(y.reshape(-1, 1)))
+        stats = {'XtWX': X.T @ (X * weights[:, None]),
+                 'XtWy': X.T @ (weights * y)}
+
+    stats['n'] = len(X)
+    return stats
+
 # Interaction effects for standard part
 def _interact(dataf, estimate):
     dataf = dataf.copy()
@@ -225,7 +294,7 @@ def data_birth(dataf, estimate=1):
     #dataf = _interact(dataf,estimate)
     return dataf
 
-def estimate_birth(dataf):
+def estimate_birth(dataf, num_threads=0):
     dataf = dataf.copy()
 
     dataf = data_birth(dataf)
@@ -240,7 +309,8 @@ def estimate_birth(dataf):
         'learning_rate': 0.05,
         'feature_fraction': [0.9],
         'num_leaves': 31,
-        'verbose': 0}
+        'verbose': 0,
+        'num_threads': num_threads}
 
     model = LogisticRegression(C=1e9)
     logit = model.fit(dict['X_train'], dict['y_train'],
@@ -255,6 +325,8 @@ def estimate_birth(dataf):
 
     pickle.dump(logit,
                 open(model_path / "birth_logit", 'wb'))
+    pickle.dump(sufficient_stats(dataf, dict['X_scaler'], logit),
+                open(model_path / "birth_logit_stats", 'wb'))
     ml.save_model(str(model_path / "birth_ml.txt"))
     pickle.dump(dict['X_scaler'],
                 open(model_path / "birth_X_scaler", 'wb'))
@@ -284,7 +356,7 @@ def data_retired(dataf, estimate=1):
 
     return dataf
 
-def estimate_retired(dataf):
+def estimate_retired(dataf, num_threads=0):
     dataf = dataf.copy()
 
     dataf = data_retired(dataf)
@@ -298,7 +370,8 @@ def estimate_retired(dataf):
         'learning_rate': 0.05,
         'feature_fraction': [0.9],
         'num_leaves': 31,
-        'verbose': 0}
+        'verbose': 0,
+        'num_threads': num_threads}
 
     model = LogisticRegression(C=1e9)
     logit = model.fit(dict['X_train'], dict['y_train'],
@@ -312,6 +385,8 @@ def estimate_retired(dataf):
 
     pickle.dump(logit,
                 open(model_path / "retired_logit", 'wb'))
+    pickle.dump(sufficient_stats(dataf, dict['X_scaler'], logit),
+                open(model_path / "retired_logit_stats", 'wb'))
     ml.save_model(str(model_path / "retired_ml.txt"))
     pickle.dump(dict['X_scaler'],
                 open(model_path / "retired_X_scaler", 'wb'))
@@ -351,7 +426,7 @@ def data_working(dataf, estimate=1):
 
     return dataf
 
-def estimate_working(dataf):
+def estimate_working(dataf, num_threads=0):
     dataf = dataf.copy()
 
     dataf = data_working(dataf)
@@ -366,7 +441,8 @@ def estimate_working(dataf):
         'learning_rate': 0.05,
         'feature_fraction': [0.9],
         'num_leaves': 31,
-        'verbose': 0}
+        'verbose': 0,
+        'num_threads': num_threads}
 
     model = LogisticRegression(C=1e9)
     logit = model.fit(dict['X_train'], dict['y_train'],
@@ -380,6 +456,8 @@ def estimate_working(dataf):
 
     pickle.dump(logit,
                 open(model_path / "working_logit", 'wb'))
+    pickle.dump(sufficient_stats(dataf, dict['X_scaler'], logit),
+                open(model_path / "working_logit_stats", 'wb'))
     ml.save_model(str(model_path / "working_ml.txt"))
     pickle.dump(dict['X_scaler'],
                 open(model_path / "working_X_scaler", 'wb'))
@@ -418,7 +496,7 @@ def data_fulltime(dataf, estimate=1):
 
     return dataf
 
-def estimate_fulltime(dataf):
+def estimate_fulltime(dataf, num_threads=0):
     dataf = dataf.copy()
 
     dataf = data_fulltime(dataf)
@@ -433,7 +511,8 @@ def estimate_fulltime(dataf):
         'learning_rate': 0.05,
         'feature_fraction': [0.9],
         'num_leaves': 31,
-        'verbose': 0}
+        'verbose': 0,
+        'num_threads': num_threads}
 
     model = LogisticRegression(C=1e9)
     logit = model.fit(dict['X_train'], dict['y_train'],
@@ -447,6 +526,8 @@ def estimate_fulltime(dataf):
 
     pickle.dump(logit,
                 open(model_path / "fulltime_logit", 'wb'))
+    pickle.dump(sufficient_stats(dataf, dict['X_scaler'], logit),
+                open(model_path / "fulltime_logit_stats", 'wb'))
     ml.save_model(str(model_path / "fulltime_ml.txt"))
     pickle.dump(dict['X_scaler'],
                 open(model_path / "fulltime_X_scaler", 'wb'))
@@ -491,7 +572,7 @@ def data_hours(dataf, estimate=1):
 
     return dataf
 
-def estimate_hours(dataf):
+def estimate_hours(dataf, num_threads=0):
     dataf = dataf.copy()
 
     dataf = data_hours(dataf)
@@ -507,7 +588,8 @@ def estimate_hours(dataf):
               'feature_fraction': [0.9],
               'bagging_fraction': [0.8],
               'bagging_freq': [5],
-              'verbose' : 5}
+              'verbose' : 5,
+              'num_threads': num_threads}
 
     model = LinearRegression()
     ols = model.fit(dict['X_train'], dict['y_train'],
@@ -521,6 +603,8 @@ def estimate_hours(dataf):
 
     pickle.dump(ols,
                 open(model_path / "hours_ols", 'wb'))
+    pickle.dump(sufficient_stats(dataf, dict['X_scaler'], ols, dict['y_scaler']),
+                open(model_path / "hours_ols_stats", 'wb'))
     ml.save_model(str(model_path / "hours_ml.txt"))
     pickle.dump(dict['y_scaler'],
                 open(model_path / "hours_y_scaler", 'wb'))
@@ -566,7 +650,7 @@ def data_earnings(dataf, estimate=1):
 
     return dataf
 
-def estimate_earnings(dataf):
+def estimate_earnings(dataf, num_threads=0):
     dataf = dataf.copy()
 
     dataf = data_earnings(dataf)
@@ -582,7 +666,8 @@ def estimate_earnings(dataf):
               'feature_fraction': [0.9],
               'bagging_fraction': [0.8],
               'bagging_freq': [5],
-              'verbose' : 5}
+              'verbose' : 5,
+              'num_threads': num_threads}
 
     model = LinearRegression()
     ols = model.fit(dict['X_train'], dict['y_train'],
@@ -596,6 +681,8 @@ def estimate_earnings(dataf):
 
     pickle.dump(ols,
                 open(model_path / "gross_earnings_ols", 'wb'))
+    pickle.dump(sufficient_stats(dataf, dict['X_scaler'], ols, dict['y_scaler']),
+                open(model_path / "gross_earnings_ols_stats", 'wb'))
     ml.save_model(str(model_path / "gross_earnings_ml.txt"))
     pickle.dump(dict['y_scaler'],
                 open(model_path / "gross_earnings_y_scaler", 'wb'))
@@ -5,47 +5,17 @@ import pickle
 
 import statsmodels.api as sm
 from sklearn.preprocessing import StandardScaler
-from sklearn.model_selection import train_test_split, GridSearchCV
+from sklearn.model_selection import train_test_split, GridSearchCV, KFold, ParameterGrid
 
 
 import lightgbm as lgb
 from sklearn.linear_model import LogisticRegression, LinearRegression
 
+from estimation.standard import getdf
+
 input_path = "/Users/christianhilscher/Desktop/dynsim/input/"
 model_path = "/Users/christianhilscher/desktop/dynsim/src/estimation/modelsWA_CV/"
 
-def getdf(dataf):
-    dataf = dataf.copy()
-
-    condition = dataf.groupby('pid')['year'].count()>2
-    dataf = dataf.set_index('pid')[condition]
-    year_list = dataf['year'].unique()
-
-    dataf['hours_t1'] = np.NaN
-    dataf['gross_earnings_t1'] = np.NaN
-
-    dataf_out = pd.DataFrame()
-    for i in np.sort(year_list)[2:]:
-        df_now = dataf[dataf['year'] == i].copy()
-        df_yesterday = dataf[dataf['year'] == (i-1)].copy()
-        df_twoyesterdays = dataf[dataf['year'] == (i-2)].copy()
-
-        df_now['retired_t1'] = df_yesterday['retired']
-        df_now['working_t1'] = df_yesterday['working']
-        df_now['fulltime_t1'] = df_yesterday['fulltime']
-        df_now['hours_t1'] = df_yesterday['hours']
-        df_now['hours_t2'] = df_twoyesterdays['hours']
-        df_now['gross_earnings_t1'] = df_yesterday['gross_earnings']
-        df_now['gross_earnings_t2'] = df_twoyesterdays['gross_earnings']
-        df_now['employment_status_t1'] = df_yesterday['employment_status']
-        df_now['employment_status_t2'] = df_twoyesterdays['employment_status']
-
-        dataf_out = pd.concat([dataf_out, df_now])
-
-    dataf_out.reset_index(inplace=True)
-    dataf_out.dropna(inplace=True)
-    return dataf_out
-
 def get_dependent_var(dataf, dep_var):
     dataf = dataf.copy()
 
@@ -181,6 +151,109 @@ def _add_constant(dataf):
     dataf = sm.add_constant(dataf)
     return dataf
 
+# Hyperparameters searched for every LightGBM model
+param_grid = {
+    'learning_rate': np.linspace(0.01, 1, 7),
+    'n_estimators': [150, 200, 250],
+    'boosting_type': ['gbdt', 'rf', 'dart'],
+    'feature_fraction': [0.9],
+    'bagging_fraction': [0.8],
+    'bagging_freq': [5]
+}
+
+def _tune(X, y, features, tuning='halving'):
+    """
+    Returns the booster with the best cross-validated parameters.
+
+    'grid' fits every combination of param_grid, 'halving' drops the bad
+    ones after a few boosting rounds.
+    """
+    if tuning == 'grid':
+        cvmodl = GridSearchCV(lgb.LGBMRegressor(num_leaves = 31),
+                              param_grid, cv=3, verbose=5, n_jobs=-1)
+        cvmodl.fit(X, y)
+        return cvmodl.best_estimator_.booster_
+    elif tuning == 'halving':
+        return _halving_search(X, y, features)
+    else:
+        raise ValueError("tuning is either 'grid' or 'halving'")
+
+def _halving_search(X, y, features, grid=param_grid, cv=3, eta=3, min_rounds=5):
+    """
+    Successive halving over grid, with the number of boosting rounds as the
+    budget.
+
+    All candidates start with a few rounds on every fold. After each rung only
+    the best 1/eta of them continue, and they keep their trees instead of
+    starting over. The fold datasets are built once and shared by all
+    candidates. The n_estimators values of grid are compared on the
+    candidates that get that far. The winner is refitted on all of X.
+    """
+    X = np.asarray(X)
+    y = np.ravel(np.asarray(y))
+
+    n_estimators = sorted(grid['n_estimators'])
+    max_rounds = n_estimators[-1]
+    candidates = [dict(params, objective='regression', metric='l2',
+                       num_leaves=31, verbose=-1)
+                  for params in ParameterGrid({key: value for key, value in grid.items()
+                                               if key != 'n_estimators'})]
+
+    folds = []
+    for train_index, valid_index in KFold(n_splits=cv).split(X):
+        train_set = lgb.Dataset(X[train_index], y[train_index],
+                                feature_name=features, free_raw_data=False)
+        valid_set = lgb.Dataset(X[valid_index], y[valid_index],
+                                reference=train_set, free_raw_data=False)
+        folds.append((train_set, valid_set))
+
+    boosters = []
+    for params in candidates:
+        fold_boosters = []
+        for train_set, valid_set in folds:
+            booster = lgb.Booster(params, train_set)
+            booster.add_valid(valid_set, 'valid')
+            fold_boosters.append(booster)
+        boosters.append(fold_boosters)
+
+    # Rounds every rung trains up to, the last one is the full budget
+    n_rungs = int(np.ceil(np.log(len(candidates)) / np.log(eta)))
+    budgets = sorted({max(min_rounds, int(np.ceil(max_rounds / eta**(n_rungs - rung))))
+                      for rung in range(n_rungs + 1)})
+
+    alive = list(range(len(candidates)))
+    rounds = np.zeros(len(candidates), dtype=int)
+    scores = {}
+    for rung, budget in enumerate(budgets):
+        losses = {}
+        for i in alive:
+            while rounds[i] < budget:
+                for booster in boosters[i]:
+                    booster.update()
+                rounds[i] += 1
+
+                if rounds[i] in n_estimators or rounds[i] == budget:
+                    loss = np.mean([booster.eval_valid()[0][2] for booster in boosters[i]])
+                    if rounds[i] in n_estimators:
+                        scores[(i, rounds[i])] = loss
+            losses[i] = loss
+
+        if rung < len(budgets) - 1:
+            n_keep = max(1, int(np.ceil(len(alive) / eta)))
+            ranked = sorted(alive, key=lambda i: losses[i])
+            alive = ranked[:n_keep]
+
+            # Eliminated candidates don't train again, free their boosters
+            for i in ranked[n_keep:]:
+                boosters[i] = None
+
+    boosters = None
+    best, best_rounds = min(scores, key=scores.get)
+    ml = lgb.train(candidates[best],
+                   lgb.Dataset(X, y, feature_name=features),
+                   num_boost_round=best_rounds)
+    return ml
+
 
 #############################################################################
 #############################################################################
@@ -211,7 +284,7 @@ def data_birth(dataf, estimate=1):
     #dataf = _interact(dataf,estimate)
     return dataf
 
-def estimate_birth(dataf):
+def estimate_birth(dataf, tuning='halving'):
     dataf = dataf.copy()
 
     dataf = data_birth(dataf)
@@ -222,26 +295,7 @@ def estimate_birth(dataf):
     logit = model.fit(dict['X_train'], dict['y_train'],
               sample_weight=dict['weights'])
 
-    estimator = lgb.LGBMRegressor(num_leaves = 31)
-    modl = estimator.fit(dict['X_train'], dict['y_train'],
-                  eval_set=[(dict['X_test'], dict['y_test'])],
-                  feature_name = dict['features'],
-                  eval_metric = 'logloss',
-                  early_stopping_rounds = 5)
-
-    param_grid = {
-        'learning_rate': np.linspace(0.01, 1, 7),
-        'n_estimators': [150, 200, 250],
-        'boosting_type': ['gbdt', 'rf', 'dart'],
-        'feature_fraction': [0.9],
-        'bagging_fraction': [0.8],
-        'bagging_freq': [5]
-    }
-
-    cvmodl = GridSearchCV(modl, param_grid, cv=3, verbose=5, n_jobs=-1)
-    cvmodl.fit(dict['X_train'], dict['y_train'])
-
-    ml = cvmodl.best_estimator_.booster_
+    ml = _tune(dict['X_train'], dict['y_train'], dict['features'], tuning)
 
     pickle.dump(logit,
                 open(model_path + "birth_logit", 'wb'))
@@ -281,7 +335,7 @@ def data_retired(dataf, estimate=1):
 
     return dataf
 
-def estimate_retired(dataf):
+def estimate_retired(dataf, tuning='halving'):
     dataf = dataf.copy()
 
     dataf = data_retired(dataf)
@@ -292,26 +346,7 @@ def estimate_retired(dataf):
     logit = model.fit(dict['X_train'], dict['y_train'],
               sample_weight=dict['weights'])
 
-    estimator = lgb.LGBMRegressor(num_leaves = 31)
-    modl = estimator.fit(dict['X_train'], dict['y_train'],
-                  eval_set=[(dict['X_test'], dict['y_test'])],
-                  feature_name = dict['features'],
-                  eval_metric = 'logloss',
-                  early_stopping_rounds = 5)
-
-    param_grid = {
-        'learning_rate': np.linspace(0.01, 1, 7),
-        'n_estimators': [150, 200, 250],
-        'boosting_type': ['gbdt', 'rf', 'dart'],
-        'feature_fraction': [0.9],
-        'bagging_fraction': [0.8],
-        'bagging_freq': [5]
-    }
-
-    cvmodl = GridSearchCV(modl, param_grid, cv=3, verbose=5, n_jobs=-1)
-    cvmodl.fit(dict['X_train'], dict['y_train'])
-
-    ml = cvmodl.best_estimator_.booster_
+    ml = _tune(dict['X_train'], dict['y_train'], dict['features'], tuning)
     ml.save_model(model_path + "retired_ml.txt")
 
     pickle.dump(logit,
@@ -351,7 +386,7 @@ def data_working(dataf, estimate=1):
 
     return dataf
 
-def estimate_working(dataf):
+def estimate_working(dataf, tuning='halving'):
     dataf = dataf.copy()
 
     dataf = data_working(dataf)
@@ -361,26 +396,7 @@ def estimate_working(dataf):
     model = LogisticRegression(C=1e9)
     logit = model.fit(dict['X_train'], dict['y_train'],
               sample_weight=dict['weights'])
-    estimator = lgb.LGBMRegressor(num_leaves = 31)
-    modl = estimator.fit(dict['X_train'], dict['y_train'],
-                  eval_set=[(dict['X_test'], dict['y_test'])],
-                  feature_name = dict['features'],
-                  eval_metric = 'logloss',
-                  early_stopping_rounds = 5)
-
-    param_grid = {
-        'learning_rate': np.linspace(0.01, 1, 7),
-        'n_estimators': [150, 200, 250],
-        'boosting_type': ['gbdt', 'rf', 'dart'],
-        'feature_fraction': [0.9],
-        'bagging_fraction': [0.8],
-        'bagging_freq': [5]
-    }
-
-    cvmodl = GridSearchCV(modl, param_grid, cv=3, verbose=5, n_jobs=-1)
-    cvmodl.fit(dict['X_train'], dict['y_train'])
-
-    ml = cvmodl.best_estimator_.booster_
+    ml = _tune(dict['X_train'], dict['y_train'], dict['features'], tuning)
 
     pickle.dump(logit,
                 open(model_path + "working_logit", 'wb'))
@@ -420,7 +436,7 @@ def data_fulltime(dataf, estimate=1):
 
     return dataf
 
-def estimate_fulltime(dataf):
+def estimate_fulltime(dataf, tuning='halving'):
     dataf = dataf.copy()
 
     dataf = data_fulltime(dataf)
@@ -431,26 +447,7 @@ def estimate_fulltime(dataf):
     model = LogisticRegression(C=1e9)
     logit = model.fit(dict['X_train'], dict['y_train'],
               sample_weight=dict['weights'])
-    estimator = lgb.LGBMRegressor(num_leaves = 31)
-    modl = estimator.fit(dict['X_train'], dict['y_train'],
-                  eval_set=[(dict['X_test'], dict['y_test'])],
-                  feature_name = dict['features'],
-                  eval_metric = 'logloss',
-                  early_stopping_rounds = 5)
-
-    param_grid = {
-        'learning_rate': np.linspace(0.01, 1, 7),
-        'n_estimators': [150, 200, 250],
-        'boosting_type': ['gbdt', 'rf', 'dart'],
-        'feature_fraction': [0.9],
-        'bagging_fraction': [0.8],
-        'bagging_freq': [5]
-    }
-
-    cvmodl = GridSearchCV(modl, param_grid, cv=3, verbose=5, n_jobs=-1)
-    cvmodl.fit(dict['X_train'], dict['y_train'])
-
-    ml = cvmodl.best_estimator_.booster_
+    ml = _tune(dict['X_train'], dict['y_train'], dict['features'], tuning)
     pickle.dump(logit,
                 open(model_path + "fulltime_logit", 'wb'))
     ml.save_model(model_path + "fulltime_ml.txt")
@@ -495,7 +492,7 @@ def data_hours(dataf, estimate=1):
 
     return dataf
 
-def estimate_hours(dataf):
+def estimate_hours(dataf, tuning='halving'):
     dataf = dataf.copy()
 
     dataf = data_hours(dataf)
@@ -506,26 +503,7 @@ def estimate_hours(dataf):
     ols = model.fit(dict['X_train'], dict['y_train'],
               sample_weight=dict['weights'])
 
-    estimator = lgb.LGBMRegressor(num_leaves = 31)
-    modl = estimator.fit(dict['X_train'], dict['y_train'],
-                  eval_set=[(dict['X_test'], dict['y_test'])],
-                  feature_name = dict['features'],
-                  eval_metric = 'l2',
-                  early_stopping_rounds = 5)
-
-    param_grid = {
-        'learning_rate': np.linspace(0.01, 1, 7),
-        'n_estimators': [150, 200, 250],
-        'boosting_type': ['gbdt', 'rf', 'dart'],
-        'feature_fraction': [0.9],
-        'bagging_fraction': [0.8],
-        'bagging_freq': [5]
-    }
-
-    cvmodl = GridSearchCV(modl, param_grid, cv=3, verbose=5, n_jobs=-1)
-    cvmodl.fit(dict['X_train'], dict['y_train'])
-
-    ml = cvmodl.best_estimator_.booster_
+    ml = _tune(dict['X_train'], dict['y_train'], dict['features'], tuning)
 
     pickle.dump(ols,
                 open(model_path + "hours_ols", 'wb'))
@@ -572,7 +550,7 @@ def data_earnings(dataf, estimate=1):
 
     return dataf
 
-def estimate_earnings(dataf):
+def estimate_earnings(dataf, tuning='halving'):
     dataf = dataf.copy()
 
     dataf = data_earnings(dataf)
@@ -583,26 +561,7 @@ def estimate_earnings(dataf):
     ols = model.fit(dict['X_train'], dict['y_train'],
               sample_weight=dict['weights'])
 
-    estimator = lgb.LGBMRegressor(num_leaves = 31)
-    modl = estimator.fit(dict['X_train'], dict['y_train'],
-                  eval_set=[(dict['X_test'], dict['y_test'])],
-                  feature_name = dict['features'],
-                  eval_metric = 'l2',
-                  early_stopping_rounds = 5)
-
-    param_grid = {
-        'learning_rate': np.linspace(0.01, 1, 7),
-        'n_estimators': [150, 200, 250],
-        'boosting_type': ['gbdt', 'rf', 'dart'],
-        'feature_fraction': [0.9],
-        'bagging_fraction': [0.8],
-        'bagging_freq': [5]
-    }
-
-    cvmodl = GridSearchCV(modl, param_grid, cv=3, verbose=5, n_jobs=-1)
-    cvmodl.fit(dict['X_train'], dict['y_train'])
-
-    ml = cvmodl.best_estimator_.booster_
+    ml = _tune(dict['X_train'], dict['y_train'], dict['features'], tuning)
 
     pickle.dump(ols,
                 open(model_path + "gross_earnings_ols", 'wb'))
@@ -3,48 +3,12 @@ import pandas as pd
 import pickle
 import os, pathlib
 
+from estimation.standard import getdf
+
 ##############################################################################
 input_path = "/Users/christianhilscher/Desktop/dynsim/input/"
 estimation_path = "/Users/christianhilscher/desktop/dynsim/src/estimation/"
 ##############################################################################
-# Getting dataframe into right shape
-def getdf(dataf):
-    dataf = dataf.copy()
-
-    # Only keeping those with more than two consective years
-    condition = dataf.groupby('pid')['year'].count()>2
-    dataf = dataf.set_index('pid')[condition]
-    year_list = dataf['year'].unique()
-
-    # Making space
-    dataf['hours_t1'] = np.NaN
-    dataf['gross_earnings_t1'] = np.NaN
-
-    # Final dataframe for output
-    dataf_out = pd.DataFrame()
-
-    # For each year use the previous year's values to fill up t-1 and t-2 columns
-    for i in np.sort(year_list)[2:]:
-        df_now = dataf[dataf['year'] == i].copy()
-        df_yesterday = dataf[dataf['year'] == (i-1)].copy()
-        df_twoyesterdays = dataf[dataf['year'] == (i-2)].copy()
-
-        df_now['retired_t1'] = df_yesterday['retired']
-        df_now['working_t1'] = df_yesterday['working']
-        df_now['fulltime_t1'] = df_yesterday['fulltime']
-        df_now['hours_t1'] = df_yesterday['hours']
-        df_now['hours_t2'] = df_twoyesterdays['hours']
-        df_now['gross_earnings_t1'] = df_yesterday['gross_earnings']
-        df_now['gross_earnings_t2'] = df_twoyesterdays['gross_earnings']
-        df_now['employment_status_t1'] = df_yesterday['employment_status']
-        df_now['employment_status_t2'] = df_twoyesterdays['employment_status']
-
-        dataf_out = pd.concat([dataf_out, df_now])
-
-    dataf_out.reset_index(inplace=True)
-    dataf_out.dropna(inplace=True)
-    return dataf_out
-
 def transition_probability(dataf, value_t, value_t1):
 
     return (sum((dataf["employment_status"]==value_t) &
@@ -83,40 +47,117 @@ def make_matrix(dataf):
 
     return pd.DataFrame(trans_mat)
 
-def write_matrices(dataf):
-    dataf = dataf.copy()
-
-    bins = np.arange(0, 101, 1)
-    dataf["age_bin"] = pd.cut(dataf["age"], bins, right=False)
-
-    dataf.sort_values("age", inplace=True)
+def transition_tensor(dataf, weight=None, n_ages=100, n_stati=4):
+    """
+    All matrices of make_matrix in one pass: one weighted bincount over
+    (female, age, employment_status, employment_status_t1).
+
+    Returns an array indexed by [female, age] holding the matrices in the
+    layout of make_matrix and the (weighted) number of rows of every cell.
+    weight is the name of a weighting column like "personweight", every
+    row counts once if it is None.
+    """
+    female = np.asarray(dataf["female"]).astype(np.int64)
+    age = np.asarray(dataf["age"]).astype(np.int64)
+    status_t = np.asarray(dataf["employment_status"])
+    status_t1 = np.asarray(dataf["employment_status_t1"])
+    if weight is None:
+        weights = None
+    else:
+        weights = np.asarray(dataf[weight], dtype=np.float64)
+
+    n_cells = 2 * n_ages
+    cell = female * n_ages + age
+    in_range = (age >= 0) & (age < n_ages)
+
+    # Statuses outside 0..n_stati-1 only count in the size of their cell
+    observed = (in_range
+                & np.isin(status_t, np.arange(n_stati))
+                & np.isin(status_t1, np.arange(n_stati)))
+    pair = (cell * n_stati + status_t.astype(np.int64, copy=False)) * n_stati \
+        + status_t1.astype(np.int64, copy=False)
+
+    joint = np.bincount(pair[observed],
+                        weights=None if weights is None else weights[observed],
+                        minlength=n_cells * n_stati * n_stati)
+    n = np.bincount(cell[in_range],
+                    weights=None if weights is None else weights[in_range],
+                    minlength=n_cells)
+
+    joint = joint.reshape(2, n_ages, n_stati, n_stati)
+    n = n.reshape(2, n_ages)
+
+    # Counts with the marginals in the last row and column
+    counts = np.zeros((2, n_ages, n_stati + 1, n_stati + 1))
+    counts[..., :n_stati, :n_stati] = joint
+    counts[..., :n_stati, -1] = joint.sum(axis=-1)
+    counts[..., -1, :n_stati] = joint.sum(axis=-2)
+
+    tensor = np.zeros_like(counts)
+    populated = n > 0
+    tensor[populated] = counts[populated] / n[populated][:, None, None]
+    tensor[..., -1, -1] = tensor[..., -1, :n_stati].sum(axis=-1)
+
+    complete = np.round(tensor[..., -1, -1][populated], decimals=2) == 1
+    if not np.all(complete):
+        raise ValueError("Marginal probabilities don't add up to 1.")
+
+    return tensor, n
+
+def estimate_matrices(dataf, weight=None, n_ages=100, n_stati=4):
+    """
+    Transition matrices of every age and sex, both as the dictionary of
+    write_matrices and as the dense array of transition_tensor. Cells
+    without observations are left out of the dictionary.
+    """
+    tensor, n = transition_tensor(dataf, weight, n_ages, n_stati)
 
     dici = {}
+    for age in range(n_ages):
+        for sex in pd.unique(dataf["female"]):
+            if n[int(sex), age] == 0:
+                continue
+            if sex == 1:
+                title = "female_" + str(age)
+            else:
+                title = "male_" + str(age)
+            dici[title] = pd.DataFrame(tensor[int(sex), age])
+    return dici, tensor
 
-    for bin in dataf["age_bin"].unique():
-        print("Age bracket starting with ", bin.left)
+def write_matrices(dataf, weight=None):
+    dici, tensor = estimate_matrices(dataf, weight)
+    return dici
 
-        for sex in dataf["female"].unique():
+def conditional_tensor(dici, n_ages=101, n_stati=4):
+    """
+    Compiles the matrices of write_matrices into one array indexed by
+    [female, age, status_t1, status_t] holding P(status_t | status_t1).
+    Cells without observations stay zero.
+    """
+    tensor = np.zeros((2, n_ages, n_stati, n_stati))
 
-            if sex == 1:
-                df_tmp = dataf[(dataf["age_bin"] == bin)&(dataf["female"]==1)]
-                title = "female_" + str(bin.left)
-            else:
-                df_tmp = dataf[(dataf["age_bin"] == bin)&(dataf["female"]==0)]
-                title = "male_" + str(bin.left)
+    for title, matrix in dici.items():
+        sex, age = title.split("_")
+        trans_mat = np.asarray(matrix)
 
+        # Rows are the status in t, columns the status in t-1
+        joint = trans_mat[:n_stati, :n_stati]
+        marginal = trans_mat[-1, :n_stati]
 
-            dici[title] = make_matrix(df_tmp)
-    return dici
+        cond = np.zeros_like(joint)
+        observed = marginal != 0
+        cond[:, observed] = joint[:, observed] / marginal[observed]
+
+        tensor[int(sex == "female"), int(age)] = cond.T
+    return tensor
 
 # Now getting transition probabilities for our cohort
 def make_cohort(dataf, birthyears):
     dataf = dataf.copy()
 
     birthyear = dataf["year"] - dataf["age"]
-    condition = [by in birthyears for by in birthyear]
+    condition = birthyear.isin(birthyears) & (dataf["east"]==0)
     dataf = dataf.loc[condition]
-    dataf = dataf[dataf["east"]==0]
 
     return dataf
 
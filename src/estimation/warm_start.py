@@ -0,0 +1,299 @@
+from pathlib import Path
+import copy
+import pickle
+import shutil
+import warnings
+import numpy as np
+import pandas as pd
+
+from scipy.special import expit
+from sklearn.model_selection import train_test_split
+from sklearn.metrics import log_loss
+
+import lightgbm as lgb
+
+from estimation.standard import getdf, split_design
+from estimation.extended import data_general
+from estimation.model_table import standard_models, extended_models
+
+###############################################################################
+dir = Path(__file__).parents[2]
+input_path = dir / "input"
+model_path = dir / "src/estimation/models/"
+###############################################################################
+
+# Boosting parameters of standard.py and extended.py for the added rounds
+params_binary = {'boosting_type' : 'gbdt',
+                 'objective': 'binary',
+                 'learning_rate': 0.05,
+                 'feature_fraction': 0.9,
+                 'num_leaves': 31,
+                 'verbose': -1}
+
+params_regression = {'boosting_type' : 'gbdt',
+                     'objective' : 'l2',
+                     'num_leaves' : 31,
+                     'learning_rate' : 0.15,
+                     'feature_fraction': 0.9,
+                     'bagging_fraction': 0.8,
+                     'bagging_freq': 5,
+                     'verbose' : -1}
+
+params_multiclass = {'boosting_type' : 'gbdt',
+                     'objective': 'multiclass',
+                     'learning_rate': 0.05,
+                     'feature_fraction': 0.9,
+                     'num_leaves': 31,
+                     'verbose': -1}
+
+
+def _logit_objective(beta, beta_old, hessian_old, X, y, weights):
+    """
+    Log likelihood of the new rows plus the quadratic approximation of the old ones
+    """
+    eta = X @ beta
+    diff = beta - beta_old
+    return np.sum(weights * (y * eta - np.logaddexp(0, eta))) - 0.5 * diff @ hessian_old @ diff
+
+def update_logit(model, stats, X, y, weights, max_iter=25, tol=1e-8, ridge=1e-8, max_halvings=30):
+    """
+    Updates a logit with new rows without the old ones.
+
+    The old data enters through a quadratic approximation of its log
+    likelihood around the old estimate, i.e. the cached Hessian. Newton steps
+    then maximise it together with the exact log likelihood of the new rows.
+    A small ridge keeps the Hessian invertible and every step is halved until
+    the objective doesn't fall. Warns if the steps haven't converged.
+    Returns the updated model, the statistics for the next update and whether
+    the update converged.
+    """
+    X = np.column_stack([np.ones(len(X)), X])
+    beta_old = np.append(model.intercept_, model.coef_.ravel())
+    hessian_old = stats['hessian']
+    identity = np.eye(len(beta_old))
+
+    beta = beta_old.copy()
+    objective = _logit_objective(beta, beta_old, hessian_old, X, y, weights)
+    converged = False
+    for _ in range(max_iter):
+        prob = expit(X @ beta)
+        gradient = hessian_old @ (beta - beta_old) + X.T @ (weights * (prob - y))
+        hessian = hessian_old + X.T @ (X * (weights * prob * (1 - prob))[:, None])
+        step = np.linalg.solve(hessian + ridge * np.trace(hessian) * identity, gradient)
+        if np.max(np.abs(step)) < tol:
+            beta -= step
+            converged = True
+            break
+
+        for _ in range(max_halvings):
+            objective_new = _logit_objective(beta - step, beta_old, hessian_old, X, y, weights)
+            if objective_new >= objective:
+                break
+            step = step / 2
+        else:
+            break
+
+        beta -= step
+        objective = objective_new
+
+    if not converged:
+        warnings.warn("Logit update did not converge, the step size is " + str(np.max(np.abs(step))))
+
+    prob = expit(X @ beta)
+    stats_new = {'hessian': hessian_old + X.T @ (X * (weights * prob * (1 - prob))[:, None]),
+                 'n': stats['n'] + len(X)}
+
+    model_new = copy.deepcopy(model)
+    model_new.intercept_ = np.reshape(beta[:1], np.shape(model.intercept_))
+    model_new.coef_ = np.reshape(beta[1:], np.shape(model.coef_))
+    return model_new, stats_new, converged
+
+def update_ols(model, stats, X, y, weights):
+    """
+    Refits an OLS on the old and new rows from the cached X'WX and X'Wy.
+    Returns the updated model and the statistics for the next update.
+    """
+    X = np.column_stack([np.ones(len(X)), X])
+    stats_new = {'XtWX': stats['XtWX'] + X.T @ (X * weights[:, None]),
+                 'XtWy': stats['XtWy'] + X.T @ (weights * y),
+                 'n': stats['n'] + len(X)}
+
+    beta = np.linalg.lstsq(stats_new['XtWX'], stats_new['XtWy'], rcond=None)[0]
+
+    model_new = copy.deepcopy(model)
+    model_new.intercept_ = np.reshape(beta[:1], np.shape(model.intercept_))
+    model_new.coef_ = np.reshape(beta[1:], np.shape(model.coef_))
+    return model_new, stats_new
+
+def continue_booster(booster, params, X, y, weights, n_rounds):
+    """
+    Adds n_rounds trees fitted on the new rows to a saved booster
+    """
+    train_set = lgb.Dataset(X, y, weight=weights)
+    return lgb.train(params,
+                     train_set = train_set,
+                     num_boost_round = n_rounds,
+                     init_model = booster)
+
+def _loss(y, pred, weights, classes=None):
+    """
+    Weighted log loss for classifiers, weighted RMSE otherwise
+    """
+    if classes is None:
+        return np.sqrt(np.average((y - pred)**2, weights=weights))
+    else:
+        return log_loss(y, pred, sample_weight=weights, labels=classes)
+
+def _report_row(approach, variable, model, old, updated, n_new, converged=True):
+    """
+    One row of report.csv. The old model is kept if the update didn't
+    converge or does worse on the held out rows.
+    """
+    return {'approach': approach,
+            'variable': variable,
+            'model': model,
+            'old': old,
+            'updated': updated,
+            'n_new': n_new,
+            'converged': converged,
+            'kept_old': (not converged) or (updated > old)}
+
+def _read_stats(path):
+    if not path.exists():
+        raise FileNotFoundError(str(path) + " is missing, estimate the model once with standard.py to cache it")
+    return pd.read_pickle(path)
+
+def _update_standard(variable, data_function, kind, train, test, model_path, out_path, n_rounds):
+    train = data_function(train).dropna()
+    test = data_function(test).dropna()
+    if len(train) == 0 or len(test) == 0:
+        return []
+
+    X_train, y_train, w_train = split_design(train)
+    X_test, y_test, w_test = split_design(test)
+
+    X_scaler = pd.read_pickle(model_path / str(variable + "_X_scaler"))
+    X_train = X_scaler.transform(np.asarray(X_train))
+    X_test = X_scaler.transform(np.asarray(X_test))
+
+    name = variable + "_" + kind
+    model = pd.read_pickle(model_path / name)
+    stats = _read_stats(model_path / str(name + "_stats"))
+    booster = lgb.Booster(model_file=str(model_path / str(variable + "_ml.txt")))
+
+    if kind == 'logit':
+        classes = [0, 1]
+        model_new, stats_new, converged = update_logit(model, stats, X_train, y_train, w_train)
+        pred_old = model.predict_proba(X_test)[:, 1]
+        pred_new = model_new.predict_proba(X_test)[:, 1]
+        params = params_binary
+    else:
+        classes = None
+        y_scaler = pd.read_pickle(model_path / str(variable + "_y_scaler"))
+        y_scaled = np.ravel(y_scaler.transform(y_train.reshape(-1, 1)))
+        model_new, stats_new = update_ols(model, stats, X_train, y_scaled, w_train)
+        converged = True
+        pred_old = np.ravel(y_scaler.inverse_transform(model.predict(X_test).reshape(-1, 1)))
+        pred_new = np.ravel(y_scaler.inverse_transform(model_new.predict(X_test).reshape(-1, 1)))
+        params = params_regression
+
+    booster_new = continue_booster(booster, params, X_train, y_train, w_train, n_rounds)
+
+    report = [_report_row('standard', variable, kind,
+                          _loss(y_test, pred_old, w_test, classes),
+                          _loss(y_test, pred_new, w_test, classes),
+                          len(train), converged),
+              _report_row('standard', variable, 'ml',
+                          _loss(y_test, booster.predict(X_test), w_test, classes),
+                          _loss(y_test, booster_new.predict(X_test), w_test, classes),
+                          len(train))]
+
+    # Models flagged kept_old stay as copied from model_path
+    if not report[0]['kept_old']:
+        pickle.dump(model_new,
+                    open(out_path / name, 'wb'))
+        pickle.dump(stats_new,
+                    open(out_path / str(name + "_stats"), 'wb'))
+    if not report[1]['kept_old']:
+        booster_new.save_model(str(out_path / str(variable + "_ml.txt")))
+    return report
+
+def _update_extended(variable, type, train, test, model_path, out_path, n_rounds):
+    train = data_general(train, variable).dropna()
+    test = data_general(test, variable).dropna()
+    if len(train) == 0 or len(test) == 0:
+        return []
+
+    X_train, y_train, w_train = split_design(train)
+    X_test, y_test, w_test = split_design(test)
+
+    X_scaler = pd.read_pickle(model_path / variable / "_X_scaler_multi")
+    X_train = X_scaler.transform(np.asarray(X_train))
+    X_test = X_scaler.transform(np.asarray(X_test))
+
+    booster = lgb.Booster(model_file=str(model_path / variable / "_extended.txt"))
+    if type == 'multiclass':
+        classes = np.arange(booster.num_model_per_iteration())
+        params = dict(params_multiclass, num_class=len(classes))
+    else:
+        classes = None
+        params = params_regression
+
+    booster_new = continue_booster(booster, params, X_train, y_train, w_train, n_rounds)
+
+    report = [_report_row('extended', variable, 'ml',
+                          _loss(y_test, booster.predict(X_test), w_test, classes),
+                          _loss(y_test, booster_new.predict(X_test), w_test, classes),
+                          len(train))]
+
+    if not report[0]['kept_old']:
+        booster_new.save_model(str(out_path / variable / "_extended.txt"))
+    return report
+
+def update_models(dataf, wave, model_path=model_path, out_path=None, n_rounds=50, test_size=0.2):
+    """
+    Re-estimates all models with the rows of a new survey wave only.
+
+    Logit and OLS models are updated from the statistics cached at their last
+    fit, boosters get n_rounds more trees fitted on the new rows. The old
+    models stay where they are. The updated ones go to out_path, by default
+    models_<wave> next to model_path, together with everything that wasn't
+    updated, so the folder can be used like model_path.
+
+    test_size of the new rows are held out to compare the old and the updated
+    models. This report (log loss for classifiers, RMSE otherwise) is saved as
+    report.csv in out_path and returned. An update that didn't converge or
+    does worse than the old model on the held out rows is not saved, the old
+    model stays in out_path and is flagged kept_old in the report.
+    """
+    model_path = Path(model_path)
+    if out_path is None:
+        out_path = model_path.parent / str("models_" + str(wave))
+    out_path = Path(out_path)
+    shutil.copytree(model_path, out_path, dirs_exist_ok=True)
+
+    panel = getdf(dataf)
+    new = panel[panel['year'] == wave]
+    if len(new) == 0:
+        raise ValueError("No rows of wave " + str(wave))
+    train, test = train_test_split(new, test_size=test_size)
+
+    report = []
+    for variable, (data_function, _, kind) in standard_models.items():
+        report += _update_standard(variable, data_function, kind, train, test,
+                                   model_path, out_path, n_rounds)
+    for variable, type in extended_models.items():
+        report += _update_extended(variable, type, train, test,
+                                   model_path, out_path, n_rounds)
+
+    report = pd.DataFrame(report)
+    report.to_csv(out_path / "report.csv", index=False)
+    return report
+
+
+###############################################################################
+if __name__ == "__main__":
+    df = pd.read_pickle(input_path / 'merged').dropna()
+
+    report = update_models(df, df['year'].max())
+    print(report)
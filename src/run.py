@@ -29,18 +29,20 @@ os.chdir(cwd)
 ###############################################################################
 
 
-df = pd.read_pickle(input_path / 'merged').dropna()
-df1 = getdf(df)
+if __name__ == "__main__":
+    df = pd.read_pickle(input_path / 'merged').dropna()
+    df1 = getdf(df)
 
-df1.sort_values(["pid", "year"], inplace=True)
-df2 = df1.drop_duplicates(subset="pid", keep="first")
+    df1.sort_values(["pid", "year"], inplace=True)
+    df2 = df1.drop_duplicates(subset="pid", keep="first")
 
 
-abc = fill_dataf(df1)
-ghi = fill_dataf(df2)
+    # One process per approach
+    abc = fill_dataf(df1, n_jobs=3, seed=2020)
+    ghi = fill_dataf(df2, n_jobs=3, seed=2020)
 
-pickle.dump(abc,
-            open(output_path / "doc_full.pkl", "wb"))
+    pickle.dump(abc,
+                open(output_path / "doc_full.pkl", "wb"))
 
-pickle.dump(ghi,
-            open(output_path / "doc_full2.pkl", "wb"))
+    pickle.dump(ghi,
+                open(output_path / "doc_full2.pkl", "wb"))
@@ -0,0 +1,116 @@
+import numpy as np
+import pandas as pd
+
+from sim.registry import registry
+
+# Compiled layouts and the feature names they produce, keyed by data
+# function, dependent variable and the names of the columns they were
+# compiled for
+_layouts = {}
+_features = {}
+
+
+def _compile(data_function, names, dep_var=None):
+    """
+    Runs the data function once on an empty frame and turns the feature
+    names it returns into operations on the population columns:
+    ('column', name), ('interact', name, 'female') or ('square', 'age').
+    """
+    dataf = pd.DataFrame({name: [] for name in names})
+    if dep_var is None:
+        features = data_function(dataf, estimate=0).columns
+    else:
+        features = data_function(dataf, dep_var, estimate=0).columns
+
+    layout = []
+    for feature in features:
+        if feature in names:
+            layout.append(('column', feature))
+        elif feature.endswith('_interacted') and feature[:-len('_interacted')] in names:
+            layout.append(('interact', feature[:-len('_interacted')], 'female'))
+        elif feature == 'age_squared':
+            layout.append(('square', 'age'))
+        else:
+            raise ValueError("Don't know how to build feature " + feature)
+    return layout, list(features)
+
+def get_layout(columns, data_function, dep_var=None, model=None):
+    """
+    Layout of the features data_function makes from columns, compiled once
+    per set of column names.
+
+    model is the key of the model in a loaded bundle ('standard/retired',
+    'extended/hours', ...). If the bundle lists other features for it than
+    the layout produces, the bundle doesn't fit this code and a ValueError
+    is raised instead of predicting from shuffled columns.
+    """
+    names = tuple(columns.columns)
+    key = (data_function, dep_var, names)
+    if key not in _layouts:
+        _layouts[key], _features[key] = _compile(data_function, names, dep_var)
+
+    expected = registry.features.get(model)
+    if expected is not None and expected['names'] != _features[key]:
+        raise ValueError("Features of " + model + " in the bundle don't match "
+                         + data_function.__name__ + ": " + str(expected['names'])
+                         + " instead of " + str(_features[key]))
+    return _layouts[key]
+
+def row_index(columns, rows=None):
+    """
+    Positions of the selected rows, all rows if rows is None
+    """
+    n = len(columns)
+    if rows is None:
+        return np.arange(n)
+    rows = np.asarray(rows)
+    if rows.dtype == bool:
+        return np.flatnonzero(rows)
+    return rows
+
+def design_matrix(columns, data_function, rows=None, dep_var=None, model=None, dtype=np.float64):
+    """
+    Feature matrix of data_function(estimate=0) for the selected rows,
+    filled straight from the column arrays into one C-contiguous array.
+
+    columns is a Population (or anything with .columns and [name]). The
+    rows are not filtered by the data function's conditions, the caller
+    selects them. model is the bundle key of the model the matrix is for,
+    see get_layout.
+    """
+    layout = get_layout(columns, data_function, dep_var, model)
+    index = row_index(columns, rows)
+
+    X = np.empty((len(index), len(layout)), dtype=dtype)
+    for j, operation in enumerate(layout):
+        values = np.asarray(columns[operation[1]])[index]
+        if operation[0] == 'interact':
+            values = values * np.asarray(columns[operation[2]])[index]
+        elif operation[0] == 'square':
+            values = values.astype(np.int64)**2
+        X[:, j] = values
+    return X
+
+class RowBlock:
+    """
+    The selected rows of a population, gathered column by column on first
+    use. Feature matrices of several models on the same rows share the
+    gathered columns, set() updates one of them with a new prediction.
+    """
+
+    def __init__(self, columns, rows=None):
+        self.source = columns
+        self.index = row_index(columns, rows)
+        self.columns = tuple(columns.columns)
+        self.gathered = {}
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, name):
+        if name not in self.gathered:
+            self.gathered[name] = np.asarray(self.source[name])[self.index]
+        return self.gathered[name]
+
+    def set(self, name, values):
+        self.gathered[name] = np.asarray(values)
@@ -17,6 +17,9 @@ model_path = dir / "src/estimation/models"
 
 from estimation.standard import data_birth
 from estimation.extended import data_general
+from sim.population import Population
+from sim.randomness import uniform
+from sim.registry import registry
 """
 ##############################################################################
 model_path = "/Users/christianhilscher/desktop/dynsim/src/estimation/models/"
@@ -36,173 +39,194 @@ fertility = pd.read_csv(input_path / "fertility.csv")
 ##############################################################################
 
 
-def death(dataf):
-    dataf = dataf.copy()
+def life_table(dataf):
+    """
+    Compiles the life table of mortality.csv into an array of death
+    probabilities indexed by [female, age]
+    """
+    ages = dataf["Age"].to_numpy().astype(np.int64)
 
-    dataf['deaths'] = 0
-    dataf.loc[dataf['age']>=dataf['age_max'], 'deaths'] = 1
-    if np.sum(dataf['deaths'])>0:
-        death_count = np.sum(dataf['deaths'])
-        dataf = dataf.loc[dataf['deaths']==0,:]
-    else:
-        death_count = 0
-    dataf.drop('deaths', axis=1, inplace=True)
-    return dataf, death_count
+    table = np.zeros((2, ages.max() + 1))
+    table[0, ages] = dataf["Men"].to_numpy()
+    table[1, ages] = dataf["Women"].to_numpy()
+    return table
 
+death_probabilities = life_table(mortality)
 
-def dating_market(dataf):
+def death(pop, rng):
     """
-    New couples finding together. Right now 20% of the singles find a new partner.
+    Persons die with the probability of the life table for their sex and
+    age, ages beyond the table get the one of its oldest age. Everybody
+    reaching age_max dies for sure.
     """
-    dataf = dataf.copy()
+    n_ages = death_probabilities.shape[1]
+    age = np.clip(pop['age'].astype(np.int64), 0, n_ages - 1)
+    cell = pop['female'].astype(np.int64) * n_ages + age
+    probability = death_probabilities.ravel()[cell]
 
-    eligible = (dataf['in_couple'] == 0) & (dataf['child'] == 0) & (dataf['n_people'] - dataf['n_children'] == 1)
+    dies = uniform(rng, pop['pid'], pop['year'], 'death') < probability
+    dies |= pop['age'] >= pop['age_max']
 
-    female_singles = dataf[eligible & (dataf['female'] == 1)]
-    male_singles = dataf[eligible & (dataf['female'] == 0)]
+    death_count = np.sum(dies)
+    if death_count > 0:
+        pop.keep(~dies)
+    return death_count
 
-    not_single = dataf[~eligible]
+
+def dating_market(pop, rng):
+    """
+    New couples finding together. Right now 20% of the singles find a new partner.
+    """
+    eligible = (pop['in_couple'] == 0) & (pop['child'] == 0) & (pop['n_people'] - pop['n_children'] == 1)
+
+    female_singles = np.flatnonzero(eligible & (pop['female'] == 1))
+    male_singles = np.flatnonzero(eligible & (pop['female'] == 0))
 
     new_couples = round(0.1 * min(len(female_singles),
                                   len(male_singles)))
 
     if new_couples>0:
-        matching_dict = _matching(female_singles,
+        matching_dict = _matching(pop,
+                                  female_singles,
                                   male_singles,
-                                  new_couples)
-
-        dataf_out = pd.concat((not_single,
-                               matching_dict['girls'],
-                               matching_dict['guys']), axis=0)
+                                  new_couples,
+                                  rng)
 
         assert(
-            len(matching_dict['girls']) == len(female_singles)
-        ), 'Lenght of dataframe is not the same as before'
-    else:
-        dataf_out = dataf
-
-    return dataf_out, new_couples
-
-def _matching(females, males, number):
-    """
-    Finding the 5 best fitting matches and then choosing randomly.
-    #TODO: think of a better way than this loop
-    """
-    partners = females.copy()
-    lucky_guys = males.sample(number)
-
-    neigh = NearestNeighbors(n_neighbors=5)
-
-    happy_girls = pd.DataFrame()
-
-    # Looping since as soon as one couple matched, that woman is no longer available
-    for i in np.arange(len(lucky_guys)):
-        neigh.fit(partners[['age',
-                            'education',
-                            'migback',
-                            'east',
-                            'n_children']])
-        bachelor = lucky_guys.iloc[i,:]
-        bachelor = bachelor[['age',
-                             'education',
-                             'migback',
-                             'east',
-                             'n_children']].to_numpy().reshape(1,-1)
-
-        partner_choice = neigh.kneighbors(bachelor)
-
-        partner = np.random.choice(np.ravel(partner_choice[1]), 1)
-        happy_girls = pd.concat([happy_girls, partners.iloc[partner,:]])
-        partners.drop(partners.iloc[partner,:].index, inplace=True)
-
-
-    happy_girls, lucky_guys = _adjust_values(happy_girls, lucky_guys)
-
-    singles_dict = {'all_female': females,
-                'all_male': males,
-                'happy_girls': happy_girls,
-                'lucky_guys': lucky_guys}
+            len(matching_dict['happy_girls']) == len(matching_dict['lucky_guys'])
+        ), 'Not every man found a partner'
 
-    out_dict = _concat_singles(singles_dict)
+        _adjust_values(pop,
+                       matching_dict['happy_girls'],
+                       matching_dict['lucky_guys'])
 
-    return out_dict
+    return new_couples
 
-def _concat_singles(dici):
+def _matching(pop, females, males, number, rng):
     """
-    Concating those who found new partners and those who didn't
+    Finding the 5 best fitting available women for every lucky man and then
+    choosing randomly. females and males are the row positions of the singles
+    in pop.
+
+    All men are matched in bulk rounds against one index over the
+    standardized characteristics of the women. If several men choose the same
+    woman, the man drawn first gets her and the others choose again in the
+    next round among the women still available.
     """
-
-    unlucky_guys = dici['all_male'][dici['all_male'].index.isin(dici['lucky_guys'].index) == False]
-
-    unhappy_girls = dici['all_female'][dici['all_female'].index.isin(dici['happy_girls'].index) == False]
-
-    girls = pd.concat((dici['happy_girls'], unhappy_girls), axis = 0)
-    guys = pd.concat((dici['lucky_guys'], unlucky_guys), axis = 0)
-
-    assert(
-        len(unlucky_guys) + len(dici['lucky_guys']) == len(dici['all_male'])
-    ), "Error in concating guys"
-
-    assert(
-        len(unhappy_girls) + len(dici['happy_girls']) == len(dici['all_female'])
-    ), "Error in concating girls"
-
-    out_dict = {'girls' : girls,
-                'guys': guys}
+    characteristics = ['age',
+                       'education',
+                       'migback',
+                       'east',
+                       'n_children']
+    n_candidates = 5
+
+    # Ordering by pid, so neither the draws nor ties in the neighbour search
+    # depend on the order of the rows
+    females = females[np.argsort(pop['pid'][females], kind='stable')]
+
+    # The men with the smallest draws are the lucky ones, in order of their draws
+    draws = uniform(rng, pop['pid'][males], pop['year'][males], 'dating')
+    lucky_guys = males[np.argsort(draws, kind='stable')[:number]]
+    choices = uniform(rng, pop['pid'][lucky_guys], pop['year'][lucky_guys], 'partner_choice')
+
+    female_chars = np.column_stack([pop[var][females] for var in characteristics]).astype(float)
+    male_chars = np.column_stack([pop[var][lucky_guys] for var in characteristics]).astype(float)
+
+    mean = female_chars.mean(axis=0)
+    std = female_chars.std(axis=0)
+    std[std == 0] = 1
+
+    neigh = NearestNeighbors().fit((female_chars - mean) / std)
+    male_chars = (male_chars - mean) / std
+
+    taken = np.zeros(len(females), dtype=bool)
+    partners = np.full(number, -1)
+    waiting = np.arange(number)
+    n_query = min(len(females), 2 * n_candidates)
+
+    while len(waiting) > 0:
+        neighbours = neigh.kneighbors(male_chars[waiting],
+                                      n_neighbors=n_query,
+                                      return_distance=False)
+        free = ~taken[neighbours]
+        n_free = free.sum(axis=1)
+
+        # Men who see less than 5 available women ask again with a wider query
+        complete = (n_free >= n_candidates) | (n_query == len(females))
+
+        # Choosing randomly among the first (up to) 5 available women
+        rank = (choices[waiting] * np.minimum(n_free, n_candidates)).astype(int)
+        column = np.argmax(np.cumsum(free, axis=1) > rank[:, None], axis=1)
+        chosen = neighbours[np.arange(len(waiting)), column]
+
+        # Conflicts go to the man drawn first, waiting is ordered by the draws
+        candidates = np.flatnonzero(complete)
+        _, first = np.unique(chosen[candidates], return_index=True)
+        winners = candidates[first]
+
+        partners[waiting[winners]] = chosen[winners]
+        taken[chosen[winners]] = True
+
+        matched = np.zeros(len(waiting), dtype=bool)
+        matched[winners] = True
+        waiting = waiting[~matched]
+
+        if not complete.all():
+            n_query = min(len(females), 2 * n_query)
+
+    happy_girls = females[partners]
+
+    out_dict = {'happy_girls': happy_girls,
+                'lucky_guys': lucky_guys}
     return out_dict
 
-def _adjust_values(females, males):
+def _adjust_values(pop, females, males):
     """
     Adjusting the values as the man moves in with the woman
     """
-    females = females.copy()
-    males = males.copy()
-
-    males.loc[:,'hid'] = females['hid'].tolist()
-    males.loc[:,'east'] = females['east'].tolist()
-    males.loc[:,'hhweight'] = females['hhweight'].tolist()
-    males.loc[:,'in_couple'] = 1
-    females.loc[:,'in_couple'] = 1
+    pop.move(males, pop['hid'][females])
+    pop['east'][males] = pop['east'][females]
+    pop['hhweight'][males] = pop['hhweight'][females]
+    pop['in_couple'][males] = 1
+    pop['in_couple'][females] = 1
 
-    return females, males
-
-def separations(dataf):
+def separations(pop, rng):
     """
     Calculates the seperations in each period.
     Only those who are married or in a relationship (in_couple) can separate
     """
-    dataf = dataf.copy()
-
-    probability = np.random.uniform(0, 1, len(dataf))
-    condition_married = (dataf['married'] == 1) & (probability<0.01)
-    condition_incouple = (dataf['in_couple'] == 1) & (dataf['married'] == 0) & (probability<0.02)
+    probability = uniform(rng, pop['pid'], pop['year'], 'separation')
+    condition_married = (pop['married'] == 1) & (probability<0.01)
+    condition_incouple = (pop['in_couple'] == 1) & (pop['married'] == 0) & (probability<0.02)
     condition_separation = (condition_married | condition_incouple)
 
-    males = (condition_separation) & (dataf['female'] == 0)
-    dataf.loc[condition_separation, ['married', 'in_couple']] = [[0, 0]]
+    males = (condition_separation) & (pop['female'] == 0)
+    pop['married'][condition_separation] = 0
+    pop['in_couple'][condition_separation] = 0
 
-    # Men move out; resetting HID
-    dataf.loc[males, 'orighid'] = dataf.loc[males, 'hid'].copy()
-    dataf.loc[males, 'hid'] += np.arange(1, np.sum(males)+1)
+    # Men move out into new households, numbered in pid order so the ids
+    # don't depend on the row order
+    movers = np.flatnonzero(males)
+    movers = movers[np.argsort(pop['pid'][movers], kind='stable')]
+    pop['orighid'][movers] = pop['hid'][movers]
+    pop.move(movers, pop.allocator().hids(len(movers)))
 
     separations_this_period = np.sum(condition_separation)
 
-    return dataf, separations_this_period
+    return separations_this_period
 
-def marriage(dataf):
+def marriage(pop, rng):
     """
     10% of all couples get married
     """
-    dataf = dataf.copy()
-
-    marriable = (dataf['married'] == 0) & (dataf['in_couple']==1)
-    probability = np.random.uniform(0, 1, len(dataf))
+    marriable = (pop['married'] == 0) & (pop['in_couple']==1)
+    probability = uniform(rng, pop['pid'], pop['year'], 'marriage')
     condition = (marriable) & (probability<0.1)
 
-    dataf.loc[condition, 'married'] = 1
+    pop['married'][condition] = 1
     marriages_this_period = np.sum(condition)
 
-    return dataf, marriages_this_period
+    return marriages_this_period
 
 def sim_birth(dataf, type):
     dataf = dataf.copy()
@@ -227,66 +251,81 @@ def scale_data(dataf):
     scaler = 0
     return X, scaler
 
-def make_new_humans(dataf):
-    """
-    Takes the mother's values and adjust some of them accordingly (setting age=0 for example)
-    """
-    dataf = dataf.copy()
-
-    df_babies = dataf[dataf['birth'] == 1].copy()
-    n_babies = len(df_babies)
-    pid_max = dataf['pid'].max()
-
-    pids = np.arange((pid_max+1), (pid_max + n_babies+1))
-    df_babies['pid'] = pids
-    df_babies['child'] = 1
-
-    gender = np.random.randint(0, 2, size=len(df_babies))
-    df_babies['female'] = gender
-    df_babies['predicted'] = 1
-
-    settozero = ['age',
-                 'gross_earnings',
-                 'in_couple',
-                 'married',
-                 'hours',
-                 'education',
-                 'employment_status',
-                 'fulltime',
-                 'retired',
-                 'working',
-                 'birth']
-
-    df_babies[settozero] = 0
-    return df_babies, n_babies
-
-def birth(dataf):
+# Columns newborns take over from their mother, all others start at zero
+inherited = ['year',
+             'hid',
+             'orighid',
+             'personweight',
+             'hhweight',
+             'east',
+             'migback',
+             'age_max',
+             'hh_income',
+             'hh_youngest_age',
+             'n_people',
+             'n_children',
+             'hh_frac_working']
+
+def fertility_table(dataf):
     """
-    Determines who gets children and then generates a new DF containing the old one plus the infants
+    Compiles the birth rates per 1000 women of fertility.csv into an array of
+    birth probabilities indexed by age
     """
-    dataf = dataf.copy()
-
-    df_possible = dataf[(dataf['female']==1) &  \
-                             (dataf['child']==0) & \
-                             (15 <= dataf['age']) & \
-                             (dataf['age'] <= 49)]
+    ages = dataf["Age"].to_numpy().astype(np.int64)
 
-    df_merged = df_possible.merge(fertility, left_on='age', right_on='Age')
+    table = np.zeros(ages.max() + 1)
+    table[ages] = dataf["1968"].to_numpy() / 1000
+    return table
 
-    probs = np.random.uniform(size=len(df_possible))
-    df_merged['birth'] = 0
+birth_probabilities = fertility_table(fertility)
 
-    cond = df_merged['1968']/1000 < probs
-    df_merged.loc[cond, 'birth']=1
-    df_merged.drop(['1968', 'Age'], axis=1, inplace=True)
+def make_new_humans(pop, mothers, rng):
+    """
+    Builds the rows of the newborns of mothers as one block from their
+    mothers' household columns
+    """
+    mothers = mothers[np.argsort(pop['pid'][mothers], kind='stable')]
+    n_babies = len(mothers)
+
+    columns = {}
+    for name, values in pop.columns.items():
+        if name in inherited:
+            columns[name] = values[mothers]
+        else:
+            columns[name] = np.zeros(n_babies, dtype=values.dtype)
+    babies = Population(columns)
+
+    babies['pid'] = pop.allocator().pids(n_babies)
+    babies['child'] = 1
+    babies['predicted'] = 1
+    if 'motherpid' in babies:
+        babies['motherpid'] = pop['pid'][mothers]
+
+    gender = uniform(rng, pop['pid'][mothers], pop['year'][mothers], 'newborn_sex') < 0.5
+    babies['female'] = gender
+    return babies, n_babies
+
+def birth(pop, rng):
+    """
+    Women between 15 and 49 give birth with the fertility rate of their age,
+    the infants are appended to the population
+    """
+    n_ages = len(birth_probabilities)
+    possible = np.flatnonzero((pop['female']==1) &
+                              (pop['child']==0) &
+                              (15 <= pop['age']) &
+                              (pop['age'] <= 49) &
+                              (pop['age'] < n_ages))
 
-    dataf_babies = df_merged[df_merged['birth']==1]
-    births_this_period = sum(cond)
+    probability = birth_probabilities[pop['age'][possible].astype(np.int64)]
+    draws = uniform(rng, pop['pid'][possible], pop['year'][possible], 'birth')
+    mothers = possible[draws < probability]
 
-    dataf_babies, births_this_period = make_new_humans(dataf)
+    pop.assign('birth', mothers, 1)
+    babies, births_this_period = make_new_humans(pop, mothers, rng)
 
-    dataf = pd.concat([dataf, dataf_babies], ignore_index=True)
-    return dataf, births_this_period
+    pop.append(babies)
+    return births_this_period
 
 
 
@@ -295,7 +334,7 @@ def _logit(X, variable):
 
     X_scaled = scale_data(X)
     #X_scaled['const'] = 1
-    estimator  = pd.read_pickle(model_path + variable + "_logit")
+    estimator = registry.logit(variable)
     pred = estimator.predict(X_scaled)
 
     pred_scaled = np.zeros(len(pred))
@@ -307,7 +346,7 @@ def _ml(X, variable):
     X = X.copy()
 
     X_scaled, scaler = scale_data(X)
-    estimator = lgb.Booster(model_file = model_path + variable + '_ml.txt')
+    estimator = registry.booster(variable)
     pred = estimator.predict(X_scaled)
 
     pred_scaled = np.zeros(len(pred))
@@ -319,8 +358,7 @@ def _ext(X, variable):
     X = X.copy()
 
     X_scaled, scaler = scale_data(X)
-    estimator = lgb.Booster(model_file = model_path + \
-                            variable + '_extended.txt')
+    estimator = registry.ext_booster(variable)
     pred = estimator.predict(X_scaled)
 
     pred_scaled = np.zeros(len(pred))
@@ -0,0 +1,34 @@
+import pandas as pd
+
+
+class HistoryStore:
+    """
+    Simulated panel kept as one chunk per approach and year.
+
+    Chunks are only concatenated when a caller asks for the full panel of an
+    approach, so adding a year doesn't copy the years before it.
+    """
+
+    def __init__(self, types):
+        self.chunks = {type: {} for type in types}
+
+    def add(self, type, year, dataf):
+        self.chunks[type][year] = dataf
+
+    def get(self, type, year):
+        return self.chunks[type][year]
+
+    def years(self, type):
+        return sorted(self.chunks[type])
+
+    def concat(self, type):
+        """
+        Returns the full panel of one approach, ordered by year
+        """
+        return pd.concat([self.chunks[type][year] for year in self.years(type)])
+
+    def to_dict(self):
+        """
+        Returns {approach: panel}, the shape fill_dataf used to return
+        """
+        return {type: self.concat(type) for type in self.chunks}
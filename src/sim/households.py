@@ -0,0 +1,272 @@
+import numpy as np
+
+hh_var_names = ['hh_income',
+                'hh_youngest_age',
+                'n_people',
+                'n_children',
+                'hh_frac_working']
+
+
+def household_segments(hid, year=None):
+    """
+    Sorts the rows by household (within year if given) once.
+
+    Returns the sort order, the position in it where every household starts
+    and for every row the number of its household.
+    """
+    hid = np.asarray(hid)
+    if year is None:
+        order = np.argsort(hid, kind='stable')
+        keys = [hid[order]]
+    else:
+        year = np.asarray(year)
+        order = np.lexsort((hid, year))
+        keys = [hid[order], year[order]]
+
+    new_household = np.ones(len(order), dtype=bool)
+    if len(order) > 1:
+        new_household[1:] = np.any([key[1:] != key[:-1] for key in keys], axis=0)
+    starts = np.flatnonzero(new_household)
+
+    group = np.empty(len(order), dtype=np.int64)
+    group[order] = np.cumsum(new_household) - 1
+    return order, starts, group
+
+def _zero_missing(values):
+    """
+    Missing values count as zero like in groupby().sum()
+    """
+    values = np.asarray(values)
+    if values.dtype.kind == 'f':
+        values = np.where(np.isnan(values), 0, values)
+    return values
+
+def _segment_sum(values, order, starts):
+    """
+    Sum per household
+    """
+    return np.add.reduceat(_zero_missing(np.asarray(values)[order]), starts)
+
+def _frac_working(n_people, n_children, total_working):
+    n_adults = n_people - n_children
+    has_adults = n_adults > 0
+
+    frac_working = np.zeros(len(n_people))
+    frac_working[has_adults] = total_working[has_adults] / n_adults[has_adults]
+    frac_working[~has_adults & (total_working > 0)] = 1
+
+    # Children could also be working, but bound it at 1
+    return np.minimum(frac_working, 1)
+
+def _aggregate(order, starts, age, child, income, working):
+    """
+    Household variables of the households whose rows order lists one after
+    the other, starting at starts. One value per household.
+    """
+    n_people = np.diff(np.append(starts, len(order)))
+    n_children = _segment_sum(child, order, starts)
+    hh_income = _segment_sum(income, order, starts)
+    total_working = _segment_sum(working, order, starts)
+    youngest = np.fmin.reduceat(np.asarray(age)[order], starts)
+
+    out_dici = {'hh_income': hh_income,
+                'hh_youngest_age': youngest,
+                'n_people': n_people,
+                'n_children': n_children,
+                'hh_frac_working': _frac_working(n_people, n_children, total_working)}
+    return out_dici
+
+def household_vars(hid, age, child, income, working, year=None, index=None):
+    """
+    Computes all household variables in one pass over the rows sorted by
+    household. Returns one array per variable in the original row order.
+    With a HouseholdIndex of hid the rows aren't sorted again.
+
+    hh_frac_working is the share of working adults, bounded at 1. In
+    households without adults it is 1 if somebody works and 0 otherwise.
+    """
+    if index is None:
+        order, starts, group = household_segments(hid, year)
+    else:
+        order, starts, group = index.members, index.indptr[:-1], index.group()
+    if len(order) == 0:
+        return {name: np.zeros(0) for name in hh_var_names}
+
+    hh_vars = _aggregate(order, starts, age, child, income, working)
+    return {name: values[group] for name, values in hh_vars.items()}
+
+def refresh_household_vars(index, changed_hids, age, child, income, working):
+    """
+    Household variables of the households in changed_hids only, the ones
+    which exist in index. Returns the rows of these households and one array
+    per variable for these rows.
+    """
+    groups = index.find(changed_hids)
+    position, rows = index.segments(groups)
+    if len(rows) == 0:
+        return rows, {name: np.zeros(0) for name in hh_var_names}
+
+    counts = index.counts()[groups]
+    starts = np.cumsum(counts) - counts
+
+    hh_vars = _aggregate(rows, starts, age, child, income, working)
+    return rows, {name: values[position] for name, values in hh_vars.items()}
+
+def shift_household_vars(index, hh_income, n_children, income, income_new, working, working_new):
+    """
+    Household income and working share after the lags income and working of
+    the persons become income_new and working_new. The change of every person
+    is added into their household, only the households whose totals change
+    are touched. Returns the rows of these households and the two variables
+    for these rows.
+    """
+    d_income = _zero_missing(income_new) - _zero_missing(income)
+    d_working = _zero_missing(working_new) - _zero_missing(working)
+    changed = np.flatnonzero((d_income != 0) | (d_working != 0))
+
+    group = index.group()[changed]
+    hh_d_income = np.bincount(group, weights=d_income[changed], minlength=len(index))
+    hh_d_working = np.bincount(group, weights=d_working[changed], minlength=len(index))
+
+    groups = np.flatnonzero((hh_d_income != 0) | (hh_d_working != 0))
+    position, rows = index.segments(groups)
+    if len(rows) == 0:
+        return rows, {'hh_income': np.zeros(0), 'hh_frac_working': np.zeros(0)}
+
+    # The share is bounded at 1, so the working total before the shift can't
+    # be read off it
+    counts = index.counts()[groups]
+    starts = np.cumsum(counts) - counts
+    total_working = _segment_sum(working, rows, starts) + hh_d_working[groups]
+    frac_working = _frac_working(counts, np.asarray(n_children)[rows[starts]], total_working)
+
+    out_dici = {'hh_income': np.asarray(hh_income)[rows] + hh_d_income[groups][position],
+                'hh_frac_working': frac_working[position]}
+    return rows, out_dici
+
+class HouseholdIndex:
+    """
+    Row positions of the members of every household in CSR form, the members
+    of household hids[k] are members[indptr[k]:indptr[k+1]].
+
+    The index is sorted once when it is built. Moved, removed and appended
+    rows are merged into it afterwards without grouping the population again.
+    Households without members are dropped.
+    """
+
+    def __init__(self, hid):
+        hid = np.asarray(hid)
+        order, starts, group = household_segments(hid)
+
+        self.hids = hid[order][starts]
+        self.indptr = np.append(starts, len(order))
+        self.members = order
+        self.n_rows = len(order)
+        self._group = group
+
+    def __len__(self):
+        return len(self.hids)
+
+    def counts(self):
+        return np.diff(self.indptr)
+
+    def group(self):
+        """
+        Number of the household of every row
+        """
+        if self._group is None:
+            group = np.empty(self.n_rows, dtype=np.int64)
+            group[self.members] = np.repeat(np.arange(len(self.hids)), self.counts())
+            self._group = group
+        return self._group
+
+    def find(self, hids):
+        """
+        Numbers of the households among hids which exist, without repeats
+        """
+        hids = np.unique(np.asarray(hids))
+        groups = np.searchsorted(self.hids, hids)
+        exists = groups < len(self.hids)
+        exists[exists] = self.hids[groups[exists]] == hids[exists]
+        return groups[exists]
+
+    def segments(self, groups):
+        """
+        Members of the households groups, one after the other. Returns the
+        position in groups and the row of every member.
+        """
+        groups = np.asarray(groups, dtype=np.int64)
+        counts = self.counts()[groups]
+
+        position = np.repeat(np.arange(len(groups)), counts)
+        offset = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+        member = self.members[np.repeat(self.indptr[groups], counts) + offset]
+        return position, member
+
+    def _set_counts(self, counts):
+        nonempty = counts > 0
+        self.hids = self.hids[nonempty]
+        self.indptr = np.append(0, np.cumsum(counts[nonempty]))
+        self._group = None
+
+    def _drop_members(self, rows):
+        dropped = np.zeros(self.n_rows, dtype=bool)
+        dropped[rows] = True
+
+        kept = ~dropped[self.members]
+        groups = np.repeat(np.arange(len(self.hids)), self.counts())
+        self.members = self.members[kept]
+        self._set_counts(np.bincount(groups[kept], minlength=len(self.hids)))
+        return dropped
+
+    def _insert(self, rows, hids):
+        """
+        Adds rows at the end of the households hids, unknown hids become new
+        households
+        """
+        rows = np.asarray(rows)
+        hids = np.asarray(hids)
+
+        position = np.searchsorted(self.hids, hids)
+        known = position < len(self.hids)
+        known[known] = self.hids[position[known]] == hids[known]
+
+        new = np.unique(hids[~known])
+        if len(new) > 0:
+            at = np.searchsorted(self.hids, new)
+            counts = np.insert(self.counts(), at, 0)
+            self.hids = np.insert(self.hids, at, new)
+            self.indptr = np.append(0, np.cumsum(counts))
+
+        groups = np.searchsorted(self.hids, hids)
+        order = np.argsort(groups, kind='stable')
+        self.members = np.insert(self.members, self.indptr[groups[order] + 1], rows[order])
+
+        counts = self.counts() + np.bincount(groups, minlength=len(self.hids))
+        self.indptr = np.append(0, np.cumsum(counts))
+        self._group = None
+
+    def move(self, rows, hids):
+        """
+        The persons in rows now live in the households hids
+        """
+        self._drop_members(rows)
+        self._insert(rows, hids)
+
+    def remove(self, rows):
+        """
+        The rows are deleted from the population, the members behind them
+        move up
+        """
+        dropped = self._drop_members(rows)
+        position = np.cumsum(~dropped) - 1
+        self.members = position[self.members]
+        self.n_rows -= int(dropped.sum())
+
+    def append(self, hids):
+        """
+        New rows are appended to the population, living in the households hids
+        """
+        rows = np.arange(self.n_rows, self.n_rows + len(hids))
+        self.n_rows += len(hids)
+        self._insert(rows, hids)
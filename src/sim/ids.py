@@ -0,0 +1,74 @@
+import numpy as np
+
+kinds = ['pid', 'hid']
+
+
+class IdAllocator:
+    """
+    Hands out new pids and hids for one simulation.
+
+    Every kind of id is a counter, a request for n ids gets the next n as one
+    contiguous block without looking at the population. Shards of a parallel
+    run get disjoint ranges, so their workers never hand out the same id.
+    The state is a few integers, it is pickled with the simulation and
+    state()/from_state() turn it into a plain dict for checkpoints.
+    """
+
+    def __init__(self, next_pid=1, next_hid=1, pid_limit=None, hid_limit=None):
+        self.next = {'pid': int(next_pid), 'hid': int(next_hid)}
+        self.limit = {'pid': pid_limit, 'hid': hid_limit}
+
+    @classmethod
+    def after(cls, pids, hids):
+        """
+        Allocator starting behind the largest pid and hid in use
+        """
+        return cls(_after(pids), _after(hids))
+
+    def take(self, kind, n):
+        """
+        The next n ids of kind ('pid' or 'hid')
+        """
+        start = self.next[kind]
+        end = start + int(n)
+        if self.limit[kind] is not None and end > self.limit[kind]:
+            raise ValueError("No " + kind + "s left in the range of this allocator")
+
+        self.next[kind] = end
+        return np.arange(start, end)
+
+    def pids(self, n):
+        return self.take('pid', n)
+
+    def hids(self, n):
+        return self.take('hid', n)
+
+    def split(self, n_shards, size):
+        """
+        Allocators for n_shards shards, every one with its own range of size
+        ids of each kind. This allocator continues behind all of them.
+        """
+        shards = []
+        for shard in range(n_shards):
+            start = {kind: self.next[kind] + shard * size for kind in kinds}
+            shards.append(IdAllocator(start['pid'], start['hid'],
+                                      start['pid'] + size, start['hid'] + size))
+
+        for kind in kinds:
+            self.next[kind] += n_shards * size
+        return shards
+
+    def state(self):
+        return {'next': dict(self.next),
+                'limit': dict(self.limit)}
+
+    @classmethod
+    def from_state(cls, state):
+        return cls(state['next']['pid'], state['next']['hid'],
+                   state['limit']['pid'], state['limit']['hid'])
+
+def _after(ids):
+    ids = np.asarray(ids)
+    if len(ids) == 0:
+        return 1
+    return int(np.nanmax(ids)) + 1
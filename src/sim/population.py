@@ -0,0 +1,161 @@
+import numpy as np
+import pandas as pd
+
+from sim.households import HouseholdIndex
+from sim.ids import IdAllocator
+
+
+class Population:
+    """
+    Column store for the persons of one simulated year.
+
+    Every variable is kept as one typed NumPy array. The yearly stages mutate
+    these arrays in place instead of copying a whole DataFrame, the container
+    is only converted back to a DataFrame at the edges of the simulation.
+    """
+
+    def __init__(self, columns, ids=None):
+        self.columns = {name: np.asarray(values) for name, values in columns.items()}
+        # IdAllocator of the simulation, shared from year to year by the caller
+        self.ids = ids
+        # HouseholdIndex of the hid column, built on first use
+        self.households = None
+        # Whether the household variables are up to date apart from the
+        # households in changed_hids, which family events changed since
+        self.hh_fresh = False
+        self.changed_hids = []
+
+        lengths = {len(values) for values in self.columns.values()}
+        if len(lengths) > 1:
+            raise ValueError("All columns need to have the same length")
+
+    @classmethod
+    def from_frame(cls, dataf):
+        return cls({name: dataf[name].to_numpy(copy=True) for name in dataf.columns})
+
+    def to_frame(self, rows=None, columns=None):
+        """
+        Returns a DataFrame of the selected rows (mask or positions) and columns
+        """
+        if columns is None:
+            columns = self.columns.keys()
+
+        if rows is None:
+            return pd.DataFrame({name: self.columns[name] for name in columns})
+        else:
+            return pd.DataFrame({name: self.columns[name][rows] for name in columns})
+
+    def __len__(self):
+        if len(self.columns) == 0:
+            return 0
+        return len(next(iter(self.columns.values())))
+
+    def __contains__(self, name):
+        return name in self.columns
+
+    def __getitem__(self, name):
+        return self.columns[name]
+
+    def __setitem__(self, name, values):
+        """
+        Overwrites a column in place; scalars are broadcast, new names are added
+        """
+        if name not in self.columns:
+            if np.ndim(values) == 0:
+                self.columns[name] = np.full(len(self), values)
+            else:
+                self.columns[name] = np.array(values)
+        else:
+            self.assign(name, slice(None), values)
+
+    def assign(self, name, rows, values):
+        """
+        Writes values into the selected rows of a column. The column is only
+        reallocated if its dtype can't hold the new values.
+        """
+        column = self.columns[name]
+        values = np.asarray(values)
+
+        # Writing hids directly makes the household index and variables
+        # stale, move() keeps them
+        if name == 'hid':
+            self.households = None
+            self.hh_fresh = False
+
+        if not np.can_cast(values.dtype, column.dtype, casting='same_kind'):
+            column = column.astype(np.result_type(column, values))
+            self.columns[name] = column
+
+        column[rows] = values
+
+    def keep(self, mask):
+        """
+        Drops all rows where mask is False
+        """
+        removed = np.flatnonzero(~np.asarray(mask))
+        self.changed_hids.append(self.columns['hid'][removed])
+        if self.households is not None:
+            self.households.remove(removed)
+
+        for name, values in self.columns.items():
+            self.columns[name] = values[mask]
+
+    def take(self, rows):
+        return Population({name: values[rows] for name, values in self.columns.items()})
+
+    def append(self, other):
+        """
+        Appends the rows of another population. Columns missing on one side are
+        filled with NaN like pd.concat does.
+        """
+        n_self = len(self)
+        n_other = len(other)
+
+        names = list(self.columns)
+        names += [name for name in other.columns if name not in self.columns]
+
+        for name in names:
+            left = self.columns.get(name, np.full(n_self, np.nan))
+            right = other.columns.get(name, np.full(n_other, np.nan))
+            self.columns[name] = np.concatenate([left, right])
+
+        self.changed_hids.append(np.asarray(other['hid']))
+        if self.households is not None:
+            self.households.append(other['hid'])
+
+    def household_index(self):
+        """
+        The HouseholdIndex of the hid column, kept up to date by move(),
+        keep() and append()
+        """
+        if self.households is None:
+            self.households = HouseholdIndex(self.columns['hid'])
+        return self.households
+
+    def move(self, rows, hids):
+        """
+        Moves the persons in rows (positions) to the households hids
+        """
+        households = self.households
+        hh_fresh = self.hh_fresh
+        self.changed_hids.append(self.columns['hid'][rows])
+        self.assign('hid', rows, hids)
+        self.changed_hids.append(self.columns['hid'][rows])
+
+        if households is not None:
+            households.move(rows, self.columns['hid'][rows])
+        self.households = households
+        self.hh_fresh = hh_fresh
+
+    def allocator(self):
+        """
+        The IdAllocator for new pids and hids, one starting behind the ids
+        of this population if the caller didn't set one
+        """
+        if self.ids is None:
+            self.ids = IdAllocator.after(self.columns['pid'], self.columns['hid'])
+        return self.ids
+
+    def copy(self):
+        return Population({name: values.copy() for name, values in self.columns.items()},
+                          self.ids)
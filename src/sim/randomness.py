@@ -0,0 +1,86 @@
+import numpy as np
+
+##############################################################################
+# Every stochastic event has its own id, so draws of different events are
+# independent even for the same person and year.
+events = {'separation': 1,
+          'marriage': 2,
+          'birth': 3,
+          'newborn_sex': 4,
+          'dating': 5,
+          'partner_choice': 6,
+          'employment_status': 7,
+          'death': 8}
+
+_M0 = np.uint64(0xD2511F53)
+_M1 = np.uint64(0xCD9E8D57)
+_W0 = 0x9E3779B9
+_W1 = 0xBB67AE85
+_MASK = np.uint64(0xFFFFFFFF)
+_SHIFT = np.uint64(32)
+##############################################################################
+
+
+def _philox4x32(counter, key, rounds=10):
+    """
+    Philox4x32 block function on arrays. counter holds four arrays and key two
+    integers, all 32 bit values kept in uint64 so the products don't overflow.
+    """
+    c0, c1, c2, c3 = counter
+    k0, k1 = int(key[0]), int(key[1])
+
+    for _ in range(rounds):
+        p0 = _M0 * c0
+        p1 = _M1 * c2
+        c0, c1, c2, c3 = ((p1 >> _SHIFT) ^ c1 ^ np.uint64(k0),
+                          p1 & _MASK,
+                          (p0 >> _SHIFT) ^ c3 ^ np.uint64(k1),
+                          p0 & _MASK)
+        k0 = (k0 + _W0) & 0xFFFFFFFF
+        k1 = (k1 + _W1) & 0xFFFFFFFF
+
+    return c0, c1, c2, c3
+
+class KeyedRandom:
+    """
+    Counter-based random numbers keyed by (pid, year, event).
+
+    A draw is a pure function of the seed and the key, so every person gets
+    the same number however the population is ordered, filtered or split
+    across processes.
+    """
+
+    def __init__(self, seed=None):
+        if not isinstance(seed, np.random.SeedSequence):
+            seed = np.random.SeedSequence(seed)
+        self.key = seed.generate_state(2, dtype=np.uint32)
+
+    def random_raw(self, pids, years, event):
+        """
+        Four arrays of 32 bit random words, one entry per pid
+        """
+        pids = np.asarray(pids).astype(np.int64).astype(np.uint64)
+        years = np.broadcast_to(np.asarray(years).astype(np.uint64), pids.shape)
+        event = np.broadcast_to(np.uint64(events[event]), pids.shape)
+
+        counter = (pids & _MASK, pids >> _SHIFT, years, event)
+        return _philox4x32(counter, self.key)
+
+    def uniform(self, pids, years, event):
+        """
+        Uniform draws on [0, 1) with 53 bit resolution
+        """
+        x0, x1, x2, x3 = self.random_raw(pids, years, event)
+        return ((x0 >> np.uint64(5)) * 67108864.0 + (x1 >> np.uint64(6))) / 9007199254740992.0
+
+def uniform(rng, pids, years, event):
+    """
+    Uniform draws for the persons pids in year(s) years.
+
+    With a KeyedRandom the draws only depend on (pid, year, event). A plain
+    numpy Generator just draws len(pids) numbers in row order.
+    """
+    if isinstance(rng, KeyedRandom):
+        return rng.uniform(pids, years, event)
+    else:
+        return rng.uniform(size=len(pids))
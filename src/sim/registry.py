@@ -0,0 +1,203 @@
+from pathlib import Path
+import json
+import numpy as np
+import pandas as pd
+
+import lightgbm as lgb
+from sklearn.preprocessing import StandardScaler
+from sklearn.linear_model import LogisticRegression, LinearRegression
+
+from estimation.bundle import bundle_version
+from estimation.model_table import standard_models, extended_models
+from estimation.transition_matrices.get_matrices import conditional_tensor
+##############################################################################
+dir = Path(__file__).parents[1]
+
+estimation_path = dir / "estimation"
+model_path = dir / "estimation/models"
+##############################################################################
+
+
+def _scaler(arrays):
+    scaler = StandardScaler()
+    scaler.mean_ = arrays['mean']
+    scaler.scale_ = arrays['scale']
+    scaler.var_ = arrays['var']
+    scaler.n_features_in_ = len(arrays['mean'])
+    return scaler
+
+def _linear(model, arrays):
+    model.coef_ = arrays['coef']
+    model.intercept_ = arrays['intercept']
+    model.n_features_in_ = arrays['coef'].shape[-1]
+    if 'classes' in arrays:
+        model.classes_ = arrays['classes']
+    return model
+
+def _fold_linear(model, X_scaler, y_scaler=None):
+    """
+    Folds the X scaler, the coefficients and the y scaler of a linear model
+    into w and b, so that X @ w + b on the unscaled features gives the linear
+    index (logit) or the prediction in original units (OLS)
+    """
+    coef = np.ravel(model.coef_) / X_scaler.scale_
+    intercept = np.ravel(model.intercept_)[0] - X_scaler.mean_ @ coef
+
+    if y_scaler is not None:
+        coef = coef * y_scaler.scale_[0]
+        intercept = intercept * y_scaler.scale_[0] + y_scaler.mean_[0]
+    return np.ascontiguousarray(coef, dtype=np.float64), float(intercept)
+
+# How the objects of every artifact kind are rebuilt from their bundle entry
+_from_arrays = {'logit': lambda arrays: _linear(LogisticRegression(), arrays),
+                'ols': lambda arrays: _linear(LinearRegression(), arrays),
+                'X_scaler': _scaler,
+                'X_scaler_multi': _scaler,
+                'y_scaler': _scaler,
+                'transition_tensor': lambda arrays: arrays['tensor']}
+
+
+class ModelRegistry:
+    """
+    Loads every estimation artifact at most once per process.
+
+    Models, scalers and transition matrices are read lazily on first use and
+    then kept in memory until they are invalidated, e.g. after a
+    re-estimation wrote new files.
+    """
+
+    def __init__(self, model_path=model_path, estimation_path=estimation_path):
+        self.model_path = Path(model_path)
+        self.estimation_path = Path(estimation_path)
+        self.cache = {}
+        self.features = {}
+
+    def _get(self, kind, variable, loader):
+        key = (kind, variable)
+        if key not in self.cache:
+            self.cache[key] = loader()
+        return self.cache[key]
+
+    def logit(self, variable):
+        return self._get('logit', variable,
+                         lambda: pd.read_pickle(self.model_path / str(variable + "_logit")))
+
+    def ols(self, variable):
+        return self._get('ols', variable,
+                         lambda: pd.read_pickle(self.model_path / str(variable + "_ols")))
+
+    def X_scaler(self, variable, multi=0):
+        if multi == 1:
+            return self._get('X_scaler_multi', variable,
+                             lambda: pd.read_pickle(self.model_path / variable / "_X_scaler_multi"))
+        else:
+            return self._get('X_scaler', variable,
+                             lambda: pd.read_pickle(self.model_path / str(variable + "_X_scaler")))
+
+    def y_scaler(self, variable):
+        return self._get('y_scaler', variable,
+                         lambda: pd.read_pickle(self.model_path / str(variable + "_y_scaler")))
+
+    def booster(self, variable):
+        return self._get('ml', variable,
+                         lambda: lgb.Booster(model_file=str(self.model_path / str(variable + '_ml.txt'))))
+
+    def ext_booster(self, variable):
+        return self._get('extended', variable,
+                         lambda: lgb.Booster(model_file=str(self.model_path / variable / '_extended.txt')))
+
+    def linear_predictor(self, variable, kind):
+        """
+        (w, b) of the logit or ols model of variable, see _fold_linear
+        """
+        if kind == 'logit':
+            loader = lambda: _fold_linear(self.logit(variable), self.X_scaler(variable))
+        else:
+            loader = lambda: _fold_linear(self.ols(variable), self.X_scaler(variable),
+                                          self.y_scaler(variable))
+        return self._get(str('linear_' + kind), variable, loader)
+
+    def transition_matrices(self):
+        return self._get('transition_matrices', 'full_sample',
+                         lambda: pd.read_pickle(self.estimation_path / "transition_matrices/full_sample"))
+
+    def transition_tensor(self):
+        """
+        Transition matrices compiled to P(status_t | status_t1) indexed by
+        [female, age, status_t1, status_t]
+        """
+        return self._get('transition_tensor', 'full_sample',
+                         lambda: conditional_tensor(self.transition_matrices()))
+
+    def preload(self):
+        """
+        Eagerly loads everything the simulation needs, e.g. before forking workers
+        """
+        for variable, (_, _, kind) in standard_models.items():
+            # Births are drawn from fixed rates, not from the birth models
+            if variable == 'birth':
+                continue
+            self.linear_predictor(variable, kind)
+            self.booster(variable)
+            self.X_scaler(variable)
+            if kind == 'ols':
+                self.y_scaler(variable)
+
+        for variable in extended_models:
+            self.ext_booster(variable)
+            self.X_scaler(variable, multi=1)
+
+        self.transition_tensor()
+
+    def load_bundle(self, bundle_path):
+        """
+        Loads every artifact of a bundle written by estimation/bundle.py.
+
+        Arrays are memory mapped, so workers share the pages and nothing is
+        unpickled. Replaces whatever was cached before. The feature names of
+        the manifest are checked against the compiled layouts of sim.design
+        when a feature matrix is built for the model.
+        """
+        bundle_path = Path(bundle_path)
+        with open(bundle_path / "manifest.json") as file:
+            manifest = json.load(file)
+        if manifest.get('version') != bundle_version:
+            raise ValueError("Unknown bundle version " + str(manifest.get('version')))
+
+        self.cache.clear()
+        for entry in manifest['artifacts']:
+            key = (entry['kind'], entry['variable'])
+            if 'model' in entry:
+                self.cache[key] = lgb.Booster(model_file=str(bundle_path / entry['model']))
+            else:
+                arrays = {name: np.load(bundle_path / file, mmap_mode='r')
+                          for name, file in entry['arrays'].items()}
+                self.cache[key] = _from_arrays[entry['kind']](arrays)
+
+        self.features = manifest['features']
+        return manifest
+
+    def invalidate(self, kind=None, variable=None):
+        """
+        Drops cached artifacts. Without arguments everything is dropped,
+        otherwise only the entries matching kind and/or variable.
+        """
+        if kind is None and variable is None:
+            self.cache.clear()
+        else:
+            dropped = set()
+            for key in list(self.cache):
+                if (kind is None or key[0] == kind) and (variable is None or key[1] == variable):
+                    del self.cache[key]
+                    dropped.add(key[1])
+
+            # Compiled artifacts are rebuilt from the ones they came from
+            for key in list(self.cache):
+                if key[0] in _derived and key[1] in dropped:
+                    del self.cache[key]
+
+# Kinds computed from other cached artifacts
+_derived = ['linear_logit', 'linear_ols', 'transition_tensor']
+
+# One registry per process, shared by all sim functions
+registry = ModelRegistry()
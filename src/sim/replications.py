@@ -0,0 +1,87 @@
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
+import pandas as pd
+import pickle
+
+from sim.simulate import fill_dataf
+##############################################################################
+
+summary_vars = ['retired',
+                'working',
+                'fulltime',
+                'hours',
+                'gross_earnings',
+                'employment_status']
+
+
+def summarize(history, variables=summary_vars):
+    """
+    Yearly means of the outcome variables for every approach of one
+    replication, taken from the chunks of the HistoryStore one by one
+    """
+    frames = []
+    for type in history.chunks:
+        means = pd.DataFrame([history.get(type, year)[variables].mean()
+                              for year in history.years(type)])
+        means.insert(0, 'year', history.years(type))
+        means['type'] = type
+        frames.append(means)
+
+    return pd.concat(frames, ignore_index=True)
+
+def aggregate(summaries, variables=summary_vars):
+    """
+    Mean, standard deviation and 5%/95% quantiles over the replications
+    """
+    dataf = pd.concat(summaries, ignore_index=True)
+
+    grouped = dataf.groupby(['type', 'year'])[variables]
+    dataf_out = pd.concat({'mean': grouped.mean(),
+                           'std': grouped.std(),
+                           'q05': grouped.quantile(0.05),
+                           'q95': grouped.quantile(0.95)}, axis=1)
+    return dataf_out
+
+def _run_replication(dataf, replication, seed, output_path):
+    history = fill_dataf(dataf, seed=seed, as_store=True)
+    summary = summarize(history)
+    summary['replication'] = replication
+
+    if output_path is not None:
+        pickle.dump(history.to_dict(),
+                    open(Path(output_path) / str("replication_" + str(replication) + ".pkl"), "wb"))
+        history = None
+
+    return history, summary
+
+def run_replications(dataf, n_replications, seed=None, n_jobs=1, output_path=None):
+    """
+    Runs fill_dataf n_replications times. Every replication gets its own
+    seed spawned from one SeedSequence, which keys the KeyedRandom draws of
+    every (pid, year, event). So the replications are independent and a run
+    is reproducible given seed, whatever n_jobs is.
+
+    The replications are kept as HistoryStores, .to_dict() gives the panels.
+    If output_path is given, every replication's panels are pickled there
+    instead of being kept in memory.
+    """
+    seeds = np.random.SeedSequence(seed).spawn(n_replications)
+    replications = np.arange(n_replications)
+
+    if n_jobs > 1:
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            futures = [executor.submit(_run_replication, dataf, i, seeds[i], output_path)
+                       for i in replications]
+            results = [future.result() for future in futures]
+    else:
+        results = [_run_replication(dataf, i, seeds[i], output_path)
+                   for i in replications]
+
+    histories = [history for history, summary in results]
+    summaries = [summary for history, summary in results]
+
+    out_dici = {'replications': histories,
+                'summaries': pd.concat(summaries, ignore_index=True),
+                'aggregated': aggregate(summaries)}
+    return out_dici
@@ -1,10 +1,17 @@
-from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 import pandas as pd
 
 
 from sim.family_module import separations, marriage, dating_market, birth, death
-from sim.work_module import sim_retired, sim_working, sim_fulltime, sim_hours, sim_earnings, scale_data, make_hh_vars, sim_multi_employment, to_binary, to_category
+from sim.history import HistoryStore
+from sim.design import RowBlock
+from sim.households import household_vars, refresh_household_vars, shift_household_vars
+from sim.ids import IdAllocator
+from sim.population import Population
+from sim.randomness import KeyedRandom
+from sim.registry import registry
+from sim.work_module import sim_retired, sim_working, sim_fulltime, sim_hours, sim_earnings, sim_multi_employment, to_binary, to_category
 """
 sim_path = "/Users/christianhilscher/Desktop/dynsim/src/sim/"
 estimation_path = "/Users/christianhilscher/desktop/dynsim/src/estimation/"
@@ -31,56 +38,77 @@ def make_cohort(dataf):
     dataf = dataf[condition]
     return dataf
 
-def _moving(dataf):
-    dataf = dataf.copy()
-
-    hid_max = dataf['hid'].max()
-    n_grownups = sum(dataf['age'] == 18)
-
-    hids = np.arange((hid_max+1), (hid_max + n_grownups+1))
-    dataf.loc[dataf['age'] == 18, 'hid'] = hids
-    dataf.loc[dataf['age'] == 18, 'child'] = 0
-    return dataf
-
-def _return_hh_vars(dataf):
-    dataf = dataf.copy()
-    now = dataf['year'].max()
-
-    dataf_new = dataf[dataf['year']==now]
-    dataf_old = dataf[dataf['year']<now]
-
-    hh_vars = ['hh_income',
-               'hh_youngest_age',
-               'n_people',
-               'n_children']
-    dataf_new.drop(hh_vars, axis=1, inplace=True)
-    dataf_new = make_hh_vars(dataf_new)
-
-    dataf_out = pd.concat([dataf_old, dataf_new], ignore_index=True)
-    return dataf_out
-
-def _shift_vars(dataf):
-    dataf = dataf.copy()
-
-    dataf['retired_t1'] = dataf['retired']
-    dataf['working_t1'] = dataf['working']
-    dataf['fulltime_t1'] = dataf['fulltime']
-    dataf['hours_t2'] = dataf['hours_t1']
-    dataf['gross_earnings_t2'] = dataf['gross_earnings_t1']
-    dataf['employment_status_t2'] = dataf['employment_status_t1']
-
-    dataf['hours_t1'] = dataf['hours']
-    dataf['gross_earnings_t1'] = dataf['gross_earnings']
-    dataf['employment_status_t1'] = dataf['employment_status']
-
-    return dataf
-
-def update(dataf):
-    dataf = dataf.copy()
-
-    dataf['year'] += 1
-    dataf['age'] += 1
-    dataf = _shift_vars(dataf)
+def _moving(pop):
+    # New households are numbered in pid order, independent of the row order
+    grownups = np.flatnonzero(pop['age'] == 18)
+    grownups = grownups[np.argsort(pop['pid'][grownups], kind='stable')]
+
+    pop.move(grownups, pop.allocator().hids(len(grownups)))
+    pop['child'][grownups] = 0
+
+def _return_hh_vars(pop):
+    """
+    Updating the household variables of the simulated year in place. If they
+    were computed for this population before, only the households whose
+    members changed since are recomputed. Changes of the lags are added in by
+    _shift_vars.
+    """
+    if pop.hh_fresh:
+        rows, hh_vars = refresh_household_vars(pop.household_index(),
+                                               np.concatenate(pop.changed_hids + [[]]),
+                                               pop['age'],
+                                               pop['child'],
+                                               pop['gross_earnings_t1'],
+                                               pop['working_t1'])
+        for var, values in hh_vars.items():
+            pop.assign(var, rows, values)
+    else:
+        hh_vars = household_vars(pop['hid'],
+                                 pop['age'],
+                                 pop['child'],
+                                 pop['gross_earnings_t1'],
+                                 pop['working_t1'],
+                                 index=pop.household_index())
+        for var, values in hh_vars.items():
+            pop[var] = values
+
+    if not np.any(pop['n_people'] > pop['n_children']):
+        raise ValueError('No adult in HH')
+    pop.hh_fresh = True
+    pop.changed_hids = []
+
+def _shift_vars(pop):
+    if pop.hh_fresh:
+        # Household income and working share are sums of the lags, the
+        # changes of the lags are added into them
+        rows, hh_vars = shift_household_vars(pop.household_index(),
+                                             pop['hh_income'],
+                                             pop['n_children'],
+                                             pop['gross_earnings_t1'],
+                                             pop['gross_earnings'],
+                                             pop['working_t1'],
+                                             pop['working'])
+        for var, values in hh_vars.items():
+            pop.assign(var, rows, values)
+
+    pop['retired_t1'] = pop['retired']
+    pop['working_t1'] = pop['working']
+    pop['fulltime_t1'] = pop['fulltime']
+    pop['hours_t2'] = pop['hours_t1']
+    pop['gross_earnings_t2'] = pop['gross_earnings_t1']
+    pop['employment_status_t2'] = pop['employment_status_t1']
+
+    pop['hours_t1'] = pop['hours']
+    pop['gross_earnings_t1'] = pop['gross_earnings']
+    pop['employment_status_t1'] = pop['employment_status']
+
+def update(pop):
+    pop['year'] += 1
+    pop['age'] += 1
+    if pop.hh_fresh:
+        # Households which only aged, the others are recomputed anyway
+        pop['hh_youngest_age'] += 1
+    _shift_vars(pop)
     estimated_vars = ['birth',
                       'retired',
                       'working',
@@ -89,77 +117,139 @@ def update(dataf):
                       'gross_earnings',
                       'employment_status']
 
-    dataf[estimated_vars] = 0
-    dataf = _moving(dataf)
-    return dataf
-
-def run_family_module(dataf, type):
-    dataf = dataf.copy()
-
-    dataf, deaths_this_period = death(dataf)
-    dataf, separations_this_period = separations(dataf)
-    dataf, marriages_this_period = marriage(dataf)
-    dataf, new_couples_this_period = dating_market(dataf)
-    dataf, births_this_period = birth(dataf)
-
-    out_dici={'dataf' : dataf}
+    for var in estimated_vars:
+        pop[var] = 0
+    _moving(pop)
+
+def run_family_module(pop, type, rng):
+    # Grouping by household once, the events keep the index up to date
+    pop.household_index()
+
+    deaths_this_period = death(pop, rng)
+    separations_this_period = separations(pop, rng)
+    marriages_this_period = marriage(pop, rng)
+    new_couples_this_period = dating_market(pop, rng)
+    births_this_period = birth(pop, rng)
+
+    out_dici = {'deaths': deaths_this_period,
+                'separations': separations_this_period,
+                'marriages': marriages_this_period,
+                'new_couples': new_couples_this_period,
+                'births': births_this_period}
     return out_dici
 
-def run_work_module(dataf, type):
-    dataf = dataf.copy()
-
-    dataf = _return_hh_vars(dataf)
+def run_work_module(pop, type, rng):
+    """
+    Runs the work models as a cascade on the one population. Every step
+    only evaluates its model on the row positions the previous step
+    selected and writes its predictions back into those rows.
+    """
+    _return_hh_vars(pop)
 
     if type == "ext":
-        empl = sim_multi_employment(dataf)
-        dataf["employment_status"] = empl
-        dataf = to_binary(dataf)
-
-        working = dataf["working"]
+        empl = sim_multi_employment(pop, rng)
+        pop.assign("employment_status", slice(None), empl)
+        to_binary(pop)
+        employed = np.flatnonzero(pop['working'] == 1)
     else:
-        retired = sim_retired(dataf, type)
-        dataf['retired'] = retired
+        rows = np.arange(len(pop))
+        retired = sim_retired(pop, type, rows)
+        pop.assign('retired', rows, retired)
 
         # From now on always conditional on being in the labor force
-        if np.sum(retired)!=len(dataf):
-            working = sim_working(dataf[dataf['retired'] == 0], type)
-        else:
-            working = 0
-        dataf.loc[dataf['retired'] == 0, 'working'] = working
+        in_labor_force = rows[retired == 0]
+        if len(in_labor_force) > 0:
+            working = sim_working(pop, type, in_labor_force)
+            pop.assign('working', in_labor_force, working)
 
         # From now on always conditional on being employed
-        if np.sum(working)>0:
-            fulltime = sim_fulltime(dataf[dataf['working'] == 1], type)
-        else:
-            fulltime = 0
-        dataf.loc[dataf['working'] == 1, 'fulltime'] = fulltime
+        employed = in_labor_force[pop['working'][in_labor_force] == 1]
+        if len(employed) > 0:
+            fulltime = sim_fulltime(pop, type, employed)
+            pop.assign('fulltime', employed, fulltime)
 
-        dataf = to_category(dataf)
+        to_category(pop)
 
-    if np.sum(working)>0:
-        hours = sim_hours(dataf[dataf['working'] == 1], type)
-    else:
-        hours = 0
-    dataf.loc[dataf['working'] == 1, 'hours'] = hours
+    # Hours and earnings are built from the same gathered rows, earnings
+    # already see the hours predicted this year
+    if len(employed) > 0:
+        block = RowBlock(pop, employed)
 
-    if np.sum(working)>0:
-        earnings = sim_earnings(dataf[dataf['working'] == 1], type)
-    else:
-        earnings = 0
-    dataf.loc[dataf['working'] == 1, 'gross_earnings'] = earnings
+        hours = sim_hours(block, type)
+        pop.assign('hours', employed, hours)
+        block.set('hours', pop['hours'][employed])
 
-    return dataf
+        earnings = sim_earnings(block, type)
+        pop.assign('gross_earnings', employed, earnings)
 ##############################################################################
 ##############################################################################
-def predict(dataf, type):
-    dataf = dataf.copy()
-
-    dataf = update(dataf)
-    dataf = run_family_module(dataf, type)['dataf']
-    dataf = run_work_module(dataf, type)
-    return dataf
-
-def fill_dataf(dataf):
+def predict_population(pop, type, rng):
+    """
+    Simulates one year for the population, all stages mutate pop in place.
+    Every random draw comes from rng, a KeyedRandom or a numpy Generator.
+    """
+    update(pop)
+    run_family_module(pop, type, rng)
+    run_work_module(pop, type, rng)
+
+def predict(dataf, type, rng=None):
+    if rng is None:
+        rng = KeyedRandom()
+
+    pop = Population.from_frame(dataf)
+    predict_population(pop, type, rng)
+    return pop.to_frame()
+
+def _fill_type(panel, start, end, type, seed, bundle=None):
+    """
+    Runs the whole year sequence of one approach and returns {year: dataf}.
+    Approaches share no state, so this can run in its own process.
+    """
+    if bundle is not None:
+        registry.load_bundle(bundle)
+
+    rng = KeyedRandom(seed)
+    df_empty = panel[start].iloc[0:0]
+
+    # New persons and households get ids nobody in the panel has, counted on
+    # from year to year
+    ids = IdAllocator.after(np.concatenate([df_year['pid'] for df_year in panel.values()]),
+                            np.concatenate([df_year['hid'] for df_year in panel.values()]))
+
+    # One population for the whole run, so the household index and
+    # variables carry over. Every year the persons observed in the next
+    # year are swapped in for the simulated ones.
+    df_base = panel[start]
+    chunks = {start: df_base}
+    pop = Population.from_frame(df_base)
+    pop.ids = ids
+    for i in np.arange(start, end):
+        df_next_year = panel.get(i+1, df_empty)
+
+        have_data = np.isin(pop['pid'], df_next_year['pid'])
+        pop.keep(~have_data)
+        predict_population(pop, type, rng)
+        pop['predicted'] = 1
+
+        chunks[i+1] = pd.concat([df_next_year,
+                                 pop.to_frame()])
+        pop.append(Population.from_frame(df_next_year))
+
+        print('Done with year', i, '. Approach: ', type)
+    return chunks
+
+def fill_dataf(dataf, n_jobs=1, seed=None, bundle=None, as_store=False):
+    """
+    Fills up the panel for all approaches. With n_jobs > 1 every approach
+    runs its year sequence in its own process.
+    seed can be an int or a SeedSequence. Every approach gets its own child
+    key and all draws are keyed by (pid, year, event), so the results depend
+    neither on n_jobs nor on the order of the rows.
+    bundle is the path of a model bundle to use instead of the single files
+    in estimation/models.
+    Returns {approach: panel}, or with as_store=True the HistoryStore of the
+    yearly chunks, which are only concatenated when a caller asks for it.
+    """
     dataf = dataf.copy()
     dataf['predicted'] = 0
 
@@ -168,37 +258,31 @@ def fill_dataf(dataf):
 
     #dataf = make_cohort(dataf)
 
-    df_base = dataf[dataf['year'] == start]
-    history_dici = {'standard': df_base,
-                    'ml': df_base,
-                    'ext': df_base}
-    base_dici = {'standard': df_base,
-                 'ml': df_base,
-                 'ext': df_base}
-    for i in np.arange(start, end):
-        df = dataf.copy()
-
-        df_next_year = df[df['year'] == i+1]
-        for type in ['standard', 'ml', 'ext']:
+    # Splitting the panel once instead of filtering it again every year
+    panel = {year: df_year for year, df_year in dataf.groupby('year')}
 
-            df_base = base_dici[type]
+    types = ['standard', 'ml', 'ext']
 
-            have_data = df_base['pid'].isin(df_next_year['pid'])
-            pids_next_year = df_base.loc[have_data, 'pid'].tolist()
+    if not isinstance(seed, np.random.SeedSequence):
+        seed = np.random.SeedSequence(seed)
+    seeds = dict(zip(types, seed.spawn(len(types))))
 
-            df_have_data = df_next_year[df_next_year['pid'].isin(pids_next_year)]
-            df_topredict = df_base[~have_data]
-            df_predicted = predict(df_topredict, type)
-            df_predicted['predicted'] = 1
-
-            df_complete = pd.concat([df_next_year,
-                                     df_predicted])
-
-            base_dici[type] = df_complete
-
-            appended = pd.concat([history_dici[type],
-                                  df_complete])
-            history_dici[type] = appended
-
-            print('Done with year', i, '. Approach: ', type)
-    return history_dici
+    if n_jobs > 1:
+        with ProcessPoolExecutor(max_workers=min(n_jobs, len(types))) as executor:
+            futures = {type: executor.submit(_fill_type, panel, start, end, type, seeds[type], bundle)
+                       for type in types}
+            results = {type: futures[type].result() for type in types}
+    else:
+        if bundle is not None:
+            registry.load_bundle(bundle)
+        results = {type: _fill_type(panel, start, end, type, seeds[type])
+                   for type in types}
+
+    history = HistoryStore(types)
+    for type in types:
+        for year, df_year in results[type].items():
+            history.add(type, year, df_year)
+
+    if as_store:
+        return history
+    return history.to_dict()
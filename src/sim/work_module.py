@@ -1,10 +1,8 @@
 from pathlib import Path
 import numpy as np
-import pandas as pd
 import pickle
 import random
 
-import lightgbm as lgb
 import statsmodels.api as sm
 from sklearn.preprocessing import StandardScaler
 ##############################################################################
@@ -15,6 +13,10 @@ model_path = dir / "estimation/models"
 
 from estimation.standard import getdf, data_retired, data_working, data_fulltime, data_hours, data_earnings
 from estimation.extended import data_general
+from sim.design import design_matrix, row_index
+from sim.households import household_vars
+from sim.randomness import uniform
+from sim.registry import registry
 
 
 """
@@ -36,56 +38,40 @@ np.random.seed(2020)
 
 # Functions used for predicting values
 def scale_data(dataf, dep_var=None, multi=0):
-    dataf = dataf.copy()
-    if multi == 1:
-
-        scaler = pd.read_pickle(model_path / dep_var / "_X_scaler_multi")
-    else:
-        scaler = pd.read_pickle(model_path / str(dep_var + "_X_scaler"))
+    scaler = registry.X_scaler(dep_var, multi)
     X = scaler.transform(np.asarray(dataf))
     return X
 
 def _logit(X, variable):
-    X = X.copy()
-
-    X_scaled = scale_data(X, variable)
-    #X_scaled['const'] = 1
-    estimator  = pd.read_pickle(model_path / str(variable + "_logit"))
-    pred = estimator.predict(X_scaled)
+    # Scaler and coefficients are folded into one weight vector
+    w, b = registry.linear_predictor(variable, 'logit')
+    index = np.asarray(X, dtype=np.float64) @ w + b
 
-    pred_scaled = np.zeros(len(pred))
-    if np.any(pred)>0.5:
-        pred_scaled[pred>0.5] = 1
+    pred_scaled = np.zeros(len(index))
+    if np.any(index>0):
+        pred_scaled[index>0] = 1
     else:
         raise ValueError('Only Zeros')
 
     return pred_scaled
 
 def _ols(X, variable):
-    X= X.copy()
-
-    X_scaled = scale_data(X, variable)
-    #X['const'] = 1
-    estimator  = pd.read_pickle(model_path / str(variable + "_ols"))
-    pred = estimator.predict(X_scaled)
-
-    scaler = pd.read_pickle(model_path / str(variable + "_y_scaler"))
-    pred_scaled = scaler.inverse_transform(pred)
+    # X scaler, coefficients and y scaler are folded into one weight vector
+    w, b = registry.linear_predictor(variable, 'ols')
+    pred_scaled = np.asarray(X, dtype=np.float64) @ w + b
     pred_scaled[pred_scaled<0] = 0
 
     return pred_scaled
 
 def _ml(X, variable):
-    X = X.copy()
-
     X_scaled = scale_data(X, variable)
-    estimator = lgb.Booster(model_file = str(model_path / str(variable + '_ml.txt')))
+    estimator = registry.booster(variable)
     pred = estimator.predict(X_scaled)
 
     if variable in ['hours', 'gross_earnings']:
         # pred_scaled = pred
         # Inverse transform regression results
-        scaler = pd.read_pickle(model_path / str(variable + "_y_scaler"))
+        scaler = registry.y_scaler(variable)
         pred_scaled = scaler.inverse_transform(pred)
     else:
         # Make binary prediction to straight 0 and 1
@@ -95,18 +81,16 @@ def _ml(X, variable):
     pred_scaled[pred_scaled<0] = 0
     return pred_scaled
 
-def _ext(X, variable):
-    X = X.copy()
-    X.reset_index(drop=True, inplace=True)
+def _ext(X, variable, rng=None, pop=None):
     X_scaled = scale_data(X, variable, multi=1)
-    estimator = lgb.Booster(model_file = str(model_path / variable / '_extended.txt'))
+    estimator = registry.ext_booster(variable)
     pred = estimator.predict(X_scaled)
 
     if variable == "employment_status":
         # last argument is how to weigh prediction vs transition matrix
         # 1 is full weight on prediction, 0 is full weight on transition matrix
-        weighted_res = get_results(X, pred, 0.25)
-        predictions = draw_status(weighted_res)
+        weighted_res = get_results(pop, pred, 0.25)
+        predictions = draw_status(weighted_res, rng, pop['pid'], pop['year'])
 
     else:
         predictions = pred
@@ -119,291 +103,191 @@ def _ext(X, variable):
 # Making household wide variables
 def make_hh_vars(dataf):
     dataf = dataf.copy()
-    dataf.set_index(['hid'],inplace=True)
-
-    dataf = _hh_income(dataf)
-    dataf = _hh_age_youngest(dataf)
-    dataf = _hh_children(dataf)
-    dataf = _hh_size(dataf)
-    dataf = _hh_fraction_working(dataf)
-    dataf.reset_index(inplace=True)
-    return dataf
-
-def _hh_income(dataf):
-    dataf = dataf.copy()
-    earnings = dataf.groupby('hid')['gross_earnings_t1'].sum()
-    dataf['hh_income'] = earnings
-    return dataf
-
-def _hh_size(dataf):
-    dataf = dataf.copy()
-    size = dataf.groupby('hid')['gross_earnings'].size()
-    dataf['n_people'] = size
-    return dataf
 
-def _hh_children(dataf):
-    dataf = dataf.copy()
-    children = dataf.groupby('hid')['child'].sum()
-    dataf['n_children'] = children
-    return dataf
-
-def _hh_fraction_working(dataf):
-    dataf = dataf.copy()
-
-    dataf = _hh_size(dataf)
-    dataf = _hh_children(dataf)
-
-    total = dataf.groupby('hid')['working_t1'].sum()
-    dataf['total_working'] = total
-
-    dataf['n_adults'] = dataf['n_people'] - dataf['n_children']
-    if dataf['n_adults'].any() == 0:
+    hh_vars = household_vars(dataf['hid'],
+                             dataf['age'],
+                             dataf['child'],
+                             dataf['gross_earnings_t1'],
+                             dataf['working_t1'])
+    if not np.any(hh_vars['n_people'] > hh_vars['n_children']):
         raise ValueError('No adult in HH')
-    else:
-        dataf['hh_frac_working'] = dataf['total_working']/dataf['n_adults']
-
-    # Children could also be working, but bound it at 1
-    dataf.loc[dataf["hh_frac_working"]>1, "hh_frac_working"] = 1
 
-    # NaN cannot occur
-    dataf.loc[dataf["hh_frac_working"].isna(), "hh_frac_working"] = 0
-
-    dataf.drop(['total_working', 'n_adults'], axis=1, inplace=True)
-    return dataf
-
-def _hh_age_youngest(dataf):
-    dataf = dataf.copy()
-
-    smallest_age = dataf.groupby('hid')['age'].min()
-    dataf['hh_youngest_age'] = smallest_age
+    for var, values in hh_vars.items():
+        dataf[var] = values
     return dataf
 
 
 ##############################################################################
 
-def sim_retired(dataf, type):
-    dataf = dataf.copy()
-
+def sim_retired(pop, type, rows=None):
     if type == 'standard':
-        X = data_retired(dataf, estimate=0)
+        X = design_matrix(pop, data_retired, rows, model='standard/retired')
         predictions = _logit(X, 'retired')
     elif type == 'ml':
-        X = data_retired(dataf, estimate=0)
+        X = design_matrix(pop, data_retired, rows, model='standard/retired')
         predictions = _ml(X, 'retired')
     elif type == "ext":
-        predictions = np.zeros(len(dataf))
+        predictions = np.zeros(len(row_index(pop, rows)))
     else:
         raise ValueError("Unkown Type")
 
     return predictions
 
-def sim_working(dataf, type):
-    dataf = dataf.copy()
-
+def sim_working(pop, type, rows=None):
     if type == 'standard':
-        X = data_working(dataf, estimate=0)
+        X = design_matrix(pop, data_working, rows, model='standard/working')
         predictions = _logit(X, 'working')
     elif type == 'ml':
-        X = data_working(dataf, estimate=0)
+        X = design_matrix(pop, data_working, rows, model='standard/working')
         predictions = _ml(X, 'working')
     elif type == "ext":
-        predictions = np.zeros(len(dataf))
+        predictions = np.zeros(len(row_index(pop, rows)))
     else:
         raise ValueError("Unkown Type")
 
     return predictions
 
-def sim_fulltime(dataf, type):
-    dataf = dataf.copy()
-
+def sim_fulltime(pop, type, rows=None):
     if type == 'standard':
-        X = data_fulltime(dataf, estimate=0)
+        X = design_matrix(pop, data_fulltime, rows, model='standard/fulltime')
         predictions = _logit(X, 'fulltime')
     elif type == 'ml':
-        X = data_fulltime(dataf, estimate=0)
+        X = design_matrix(pop, data_fulltime, rows, model='standard/fulltime')
         predictions = _ml(X, 'fulltime')
     elif type == "ext":
-        predictions = np.zeros(len(dataf))
+        predictions = np.zeros(len(row_index(pop, rows)))
     else:
         raise ValueError("Unkown Type")
 
     return predictions
 
-def sim_hours(dataf, type):
-    dataf = dataf.copy()
-
+def sim_hours(pop, type, rows=None):
     if type == 'standard':
-        X = data_hours(dataf, estimate=0)
+        X = design_matrix(pop, data_hours, rows, model='standard/hours')
         predictions = _ols(X, 'hours')
     elif type == 'ml':
-        X = data_hours(dataf, estimate=0)
+        X = design_matrix(pop, data_hours, rows, model='standard/hours')
         predictions = _ml(X, 'hours')
     elif type == "ext":
-        X = data_general(dataf, "hours", estimate=0)
+        X = design_matrix(pop, data_general, rows, dep_var="hours", model="extended/hours")
         predictions = _ext(X, "hours")
     else:
         raise ValueError("Unkown Type")
 
     return predictions
 
-def sim_earnings(dataf, type):
-    dataf = dataf.copy()
-
+def sim_earnings(pop, type, rows=None):
     if type == 'standard':
-        X = data_earnings(dataf, estimate=0)
+        X = design_matrix(pop, data_earnings, rows, model='standard/gross_earnings')
         predictions = _ols(X, 'gross_earnings')
     elif type == 'ml':
-        X = data_earnings(dataf, estimate=0)
+        X = design_matrix(pop, data_earnings, rows, model='standard/gross_earnings')
         predictions = _ml(X, 'gross_earnings')
     elif type == "ext":
-        X = data_general(dataf, "gross_earnings", estimate=0)
+        X = design_matrix(pop, data_general, rows, dep_var="gross_earnings", model="extended/gross_earnings")
         predictions = _ext(X, "gross_earnings")
     else:
         raise ValueError("Unkown Type")
 
     return predictions
 
-def sim_multi_employment(dataf):
-    dataf = dataf.copy()
-
-    X = data_general(dataf, "employment_status", estimate=0)
-    predictions = _ext(X, "employment_status")
+def sim_multi_employment(pop, rng):
+    X = design_matrix(pop, data_general, dep_var="employment_status", model="extended/employment_status")
+    predictions = _ext(X, "employment_status", rng, pop)
 
     return predictions
 
 
-def to_category(dataf):
-    dataf = dataf.copy()
+def to_category(pop):
+    ne = (pop["working"]==0) & (pop["retired"] == 0)
+    teilzeit = (pop["working"]==1)&(pop["fulltime"]==0)
+    vollzeit = (pop["working"]==1)&(pop["fulltime"]==1)
 
-    ne = (dataf["working"]==0) & (dataf["retired"] == 0)
-    teilzeit = (dataf["working"]==1)&(dataf["fulltime"]==0)
-    vollzeit = (dataf["working"]==1)&(dataf["fulltime"]==1)
+    pop.assign("employment_status", ne, 0)
+    pop.assign("employment_status", pop["retired"]==1, 1)
+    pop.assign("employment_status", teilzeit, 2)
+    pop.assign("employment_status", vollzeit, 3)
 
-    dataf.loc[ne, "employment_status"] = 0
-    dataf.loc[dataf["retired"]==1, "employment_status"] = 1
-    dataf.loc[teilzeit, "employment_status"] = 2
-    dataf.loc[vollzeit, "employment_status"] = 3
+def to_binary(pop):
+    ne = pop["employment_status"] == 0
+    pop.assign("working", ne, 0)
+    pop.assign("retired", ne, 0)
+    pop.assign("fulltime", ne, 0)
 
-    return dataf
+    rente = pop["employment_status"] == 1
+    pop.assign("working", rente, 0)
+    pop.assign("fulltime", rente, 0)
+    pop.assign("retired", rente, 1)
 
-def to_binary(dataf):
-    dataf = dataf.copy()
-
-    ne = dataf["employment_status"] == 0
-    dataf.loc[ne, "working"] = 0
-    dataf.loc[ne, "retired"] = 0
-    dataf.loc[ne, "fulltime"] = 0
-
-    rente = dataf["employment_status"] == 1
-    dataf.loc[rente, "working"] = 0
-    dataf.loc[rente, "fulltime"] = 0
-    dataf.loc[rente, "retired"] = 1
+    teilzeit = pop["employment_status"] == 2
+    pop.assign("working", teilzeit, 1)
+    pop.assign("fulltime", teilzeit, 0)
+    pop.assign("retired", teilzeit, 0)
 
-    teilzeit = dataf["employment_status"] == 2
-    dataf.loc[teilzeit, "working"] = 1
-    dataf.loc[teilzeit, "fulltime"] = 0
-    dataf.loc[teilzeit, "retired"] = 0
-
-    vollzeit = dataf["employment_status"] == 3
-    dataf.loc[vollzeit, "working"] = 1
-    dataf.loc[vollzeit, "fulltime"] = 1
-    dataf.loc[vollzeit, "retired"] = 0
-
-    return dataf
+    vollzeit = pop["employment_status"] == 3
+    pop.assign("working", vollzeit, 1)
+    pop.assign("fulltime", vollzeit, 1)
+    pop.assign("retired", vollzeit, 0)
 
 # Functions for transition matrices
 def read_transition_data():
-    trans_matrices = pd.read_pickle(estimation_path / "transition_matrices/full_sample")
+    trans_matrices = registry.transition_matrices()
     return trans_matrices
 
-def get_access(dataf):
-
-    dataf["sex"] = "female"
-    dataf.loc[dataf["female"]==0, "sex"] = "male"
-
-    bins = np.arange(0, 101, 1)
-    dataf["age_bin"] = pd.cut(dataf["age"], bins)
-    dataf["left"] = [str(bin.right) for bin in dataf["age_bin"]]
-    dataf["left"] = dataf["left"]
-
-    dataf["name"] = list(zip(dataf["sex"], dataf["left"]))
-    dataf["name"] = dataf["name"].apply(get_name)
-
-    dataf.drop("sex", axis=1, inplace=True)
-    dataf.drop("age_bin", axis=1, inplace=True)
-    dataf.drop("left", axis=1, inplace=True)
-
-    return dataf
-
-def get_name(itr):
-    seq = (itr[0], itr[1])
-    sep = "_"
-    return sep.join(seq)
-
-def get_cond_prob(age_interval, employment_status, dici):
-    probs = dici[age_interval].iloc[0:4, int(employment_status)]
-    marg_prob = dici[age_interval].iloc[-1, int(employment_status)]
-
-    if marg_prob != 0:
-        out = probs/marg_prob
-    else:
-        out = np.zeros(4)
-    return out
-
 def weighting(prediction, transition, share_prediction):
-    weighted = np.empty_like(prediction)
-    out = np.empty(len(prediction))
-
     weighted = share_prediction * prediction + (1-share_prediction) * transition
     return weighted
 
 def get_results(dataf, predictions, share):
-    dataf = dataf.copy()
-
-    transition_matrices = read_transition_data()
+    """
+    Weighs the predicted probabilities with the transition probabilities
+    given sex, age and last year's employment status
+    """
+    tensor = registry.transition_tensor()
 
-    # Adapt dataframe to compare probabilities
-    dataf = get_access(dataf)
-    dataf.reset_index(drop=True, inplace=True)
+    female = np.asarray(dataf["female"]).astype(int)
+    age = np.clip(np.asarray(dataf["age"]).astype(int), 0, tensor.shape[1]-1)
+    status = np.asarray(dataf["employment_status_t1"]).astype(int)
 
-    own_prob = np.zeros_like(predictions)
-    i = 0
-    for (name, empl) in zip(dataf["name"], dataf["employment_status_t1"]):
-        own_prob[i] = get_cond_prob(name,
-                                    empl,
-                                    transition_matrices)
-        i += 1
+    # One gather instead of a lookup per person
+    own_prob = tensor[female, age, status]
 
     # Do the weighting
     out = weighting(predictions, own_prob, share)
     return out
 
-def draw_status(weighted_results):
-    np.random.seed(2020)
-
-    # Adding zero for intervals later
-    withzeros = np.zeros((weighted_results.shape[0],
-                          weighted_results.shape[1] + 1))
-
-    withzeros[:, 1:] = weighted_results
-
-    # cumulate and make intervals
-    cumulated = [withzeros[i,:].cumsum() for i in np.arange(len(withzeros))]
-    intervs = [pd.arrays.IntervalArray.from_breaks(i) for i in cumulated]
+def sample_categories(probabilities, draws):
+    """
+    Vectorized categorical draw. Row i gets the first category whose
+    cumulated probability reaches draws[i]. Rows are normalized to sum to one.
+    """
+    cumulated = np.cumsum(probabilities, axis=1)
+    total = cumulated[:, -1:]
+    cumulated = cumulated / np.where(total > 0, total, 1)
+
+    categories = np.sum(cumulated < draws[:, None], axis=1)
+    return np.minimum(categories, probabilities.shape[1] - 1)
+
+def draw_status(weighted_results, rng=None, pids=None, years=None, strict=False):
+    """
+    Draws one status per row of the weighted probabilities, with strict=True
+    the most likely status is taken instead.
+    rng is a numpy Generator or, together with pids and years, a KeyedRandom.
+    """
+    if strict:
+        return draw_status_strict(weighted_results)
+
+    if rng is None:
+        rng = np.random.default_rng()
 
     # random draw
-    draw = np.random.uniform(size=withzeros.shape[0])
-
-    # depending on random draw assign status
-    status = np.empty(len(draw))
-    for stat in np.arange(4):
-
-        cond = [draw[i] in intervs[i][stat] for i in np.arange(len(draw))]
-        status[cond] = stat
+    if pids is None:
+        draw = rng.uniform(size=weighted_results.shape[0])
+    else:
+        draw = uniform(rng, pids, years, 'employment_status')
 
+    status = sample_categories(weighted_results, draw)
     return status
 
 def draw_status_strict(weighted_results):
-    draws = np.empty(len(weighted_results))
-    draws = [np.argmax(weighted_results[i,:]) for i in np.arange(len(weighted_results))]
-    return np.array(draws)
+    return np.argmax(weighted_results, axis=1)